@@ -1,4 +1,6 @@
 import threading
+import array
+import bisect
 import json
 import time
 import smtplib
@@ -8,6 +10,11 @@ import logging
 import shutil
 import __init__ as init
 
+try:
+    import numpy as np
+except ImportError:
+    np = None  # The preamble detection scans sample by sample
+
 
 __author__ = 'Wolfrax'
 
@@ -19,18 +26,21 @@ options. Methods are:
     _apply_phase_correction: tries to correct when there is a time shift detected in the signal (CPU intensive)
     _alt_apply_phase_correction: similar to above but simpler
     _detect_adsb: scans samples for a valid preamble
-    _hex_str_2_bin_str: conversion
-    _alt_crc_func: calculates a crc sum using a lookup table
-    _crc_func(: calculates a crc sum using the GENERATOR polynom
-    crc: calls either _alt_crc_func or _crc_func, this function are called by other classes
-    correct_biterror: tries to correct biterrors by flipping bits (CPU consuming)
+    _detect_adsb_batch: same as _detect_adsb but using numpy masks, called by _detect_adsb if numpy is available
+    _detect_candidates: all preambles detected by the numpy masks, before skipping those within detected messages
+    _skip_detected: skips candidates within detected messages
+    _slice_frames: converts the samples of many messages into bytes in one go
+    crc: calculates the crc syndrome of a message (long) using a byte wise lookup table
+    crc_bytes: same as crc but on the message as bytes
+    crc_batch: calculates the crc syndromes of many messages, a numpy array of bytes
+    correct_biterror: tries to correct biterrors by looking up the syndrome in a table of bit error syndromes
+    _syndrome_table: builds the table used by correct_biterror, once for each message length
     _preamble_signal_strength: estimates the signal strength of the preamble
     _check_phase: tries to estimates how much out of phase the sampling is
     _detect_preamble: tries to detect a preamble among the samples
-    crc_2_int: conversion
-    _bin_list_2_hex_str: conversion
+    _detect_preambles: vectorised _detect_preamble, returns all indexes where a preamble is detected
 
-Included is the RepeatTimer and Stats classes.
+Included is the FrameBatch, RepeatTimer, Stats and BudgetMonitor classes.
 """
 
 with open("squitter.json", "r") as f:
@@ -40,11 +50,28 @@ with open("spots_config.json", "r") as f:
     config_json = json.load(f)
 
 
-class ADSB:
+def _crc_table(generator):
+    """
+    Byte wise lookup table for the 24 bit crc with generator polynom (a string of binaries, the leading bit is implicit)
+    Entry n is the crc register after shifting in byte n.
+    """
+    polynom = int(generator, base=2) & 0xFFFFFF
+    table = []
+    for byte in range(256):
+        crc = byte << 16
+        for _ in range(8):
+            crc = (crc << 1) ^ polynom if crc & 0x800000 else crc << 1
+        table.append(crc & 0xFFFFFF)
+    return tuple(table)
+
+
+class ADSB(object):
     """
     This class defines fundamental constants and is not supposed to be instantiated
     """
 
+    __slots__ = ()  # So that subclasses can use slots (squitter.Squitter)
+
     VERSION = init.__version__
 
     # basic constants
@@ -75,43 +102,44 @@ class ADSB:
 
     METER_PER_FOOT = 0.3048
     KPH_PER_KNOT = 1.852
+    EARTH_RADIUS_KM = 6371.0
 
     MAX_17_BITS = float(2**17)
 
     # Downlink formats
-    DF_SHORT_AIR2AIR_SURVEILLANCE_0 = "0"
-    DF_UNKNOWN_1 = "1"
-    DF_UNKNOWN_2 = "2"
-    DF_UNKNOWN_3 = "3"
-    DF_SURVEILLANCE_ALTITUDE_REPLY_4 = "4"
-    DF_SURVEILLANCE_IDENTITY_REPLY_5 = "5"
-    DF_UNKNOWN_6 = "6"
-    DF_UNKNOWN_7 = "7"
-    DF_UNKNOWN_8 = "8"
-    DF_UNKNOWN_9 = "9"
-    DF_UNKNOWN_10 = "10"
-    DF_ALL_CALL_REPLY_11 = "11"
-    DF_UNKNOWN_12 = "12"
-    DF_UNKNOWN_13 = "13"
-    DF_UNKNOWN_14 = "14"
-    DF_UNKNOWN_15 = "15"
-    DF_LONG_AIR2AIR_SURVEILLANCE_16 = "16"
-    DF_ADSB_MSG_17 = "17"
-    DF_EXTENDED_SQUITTER_18 = "18"
-    DF_MILITARY_EXTENDED_SQUITTER_19 = "19"
-    DF_COMM_BDS_ALTITUDE_REPLY_20 = "20"
-    DF_COMM_BDS_IDENTITY_REPLY_21 = "21"
-    DF_MILITARY_USE_22 = "22"
-    DF_UNKNOWN_23 = "23"
-    DF_COMM_D_EXTENDED_LENGTH_MESSAGE_24 = "24"
-    DF_UNKNOWN_25 = "25"
-    DF_UNKNOWN_26 = "26"
-    DF_UNKNOWN_27 = "27"
-    DF_UNKNOWN_28 = "28"
-    DF_UNKNOWN_29 = "29"
-    DF_UNKNOWN_30 = "30"
-    DF_UNKNOWN_31 = "31"
-    DF_SSR_MODE_AC_REPLY_32 = "32"
+    DF_SHORT_AIR2AIR_SURVEILLANCE_0 = 0
+    DF_UNKNOWN_1 = 1
+    DF_UNKNOWN_2 = 2
+    DF_UNKNOWN_3 = 3
+    DF_SURVEILLANCE_ALTITUDE_REPLY_4 = 4
+    DF_SURVEILLANCE_IDENTITY_REPLY_5 = 5
+    DF_UNKNOWN_6 = 6
+    DF_UNKNOWN_7 = 7
+    DF_UNKNOWN_8 = 8
+    DF_UNKNOWN_9 = 9
+    DF_UNKNOWN_10 = 10
+    DF_ALL_CALL_REPLY_11 = 11
+    DF_UNKNOWN_12 = 12
+    DF_UNKNOWN_13 = 13
+    DF_UNKNOWN_14 = 14
+    DF_UNKNOWN_15 = 15
+    DF_LONG_AIR2AIR_SURVEILLANCE_16 = 16
+    DF_ADSB_MSG_17 = 17
+    DF_EXTENDED_SQUITTER_18 = 18
+    DF_MILITARY_EXTENDED_SQUITTER_19 = 19
+    DF_COMM_BDS_ALTITUDE_REPLY_20 = 20
+    DF_COMM_BDS_IDENTITY_REPLY_21 = 21
+    DF_MILITARY_USE_22 = 22
+    DF_UNKNOWN_23 = 23
+    DF_COMM_D_EXTENDED_LENGTH_MESSAGE_24 = 24
+    DF_UNKNOWN_25 = 25
+    DF_UNKNOWN_26 = 26
+    DF_UNKNOWN_27 = 27
+    DF_UNKNOWN_28 = 28
+    DF_UNKNOWN_29 = 29
+    DF_UNKNOWN_30 = 30
+    DF_UNKNOWN_31 = 31
+    DF_SSR_MODE_AC_REPLY_32 = 32
 
     # Type codes
     TC_NO_INFO_0 = 0
@@ -165,6 +193,8 @@ class ADSB:
 
     GENERATOR = "1111111111111010000001001"
 
+    MODES_CRC_TABLE = _crc_table(GENERATOR)
+
     NL = (
         87.00000000, 86.53536998, 85.75541621, 84.89166191, 83.99173563, 83.07199445, 82.13956981, 81.19801349,
         80.24923213, 79.29428225, 78.33374083, 77.36789461, 76.39684391, 75.42056257, 74.43893416, 73.45177442,
@@ -182,26 +212,45 @@ class ADSB:
     cfg_check_phase = config["check phase"]
     cfg_use_metric = config["use metric"]
     cfg_apply_bit_err_correction = config["apply bit err correction"]
+    # Max no of bits to correct per downlink format, formats not included are not corrected
+    cfg_bit_err_correction = {int(df): bits for df, bits in config["bit err correction"].items()}
     cfg_run_as_daemon = config["run as daemon"]
     cfg_read_from_file = config["read from file"]
     cfg_file_name = config["file name"]
     cfg_use_text_display = config["use text display"]
     cfg_max_blip_ttl = config["max blip ttl"]
+    cfg_msgq_high_water = config["message queue high water"]
     cfg_verbose_logging = config["verbose logging"]
     cfg_check_crc = config["check crc"]
+    cfg_lazy_decode = config["lazy decode"]
     cfg_latitude = config["user latitude"]
     cfg_longitude = config["user longitude"]
+    cfg_local_cpr = config["local cpr"]
+    cfg_local_cpr_max_range = config["local cpr max range"]
+    cfg_local_cpr_surface_max_range = config["local cpr surface max range"]
     cfg_log_file = config["log file"]
     cfg_log_max_bytes = config["log max bytes"]
     cfg_log_backup_count = config["log backup count"]
     cfg_server_address = config["spots server address"]
     cfg_server_port = config["spots server port"]
+    cfg_server_max_requests = config["spots server max requests"]
+    cfg_subscriber_buffer = config["subscriber buffer"]
+    cfg_subscriber_overflow = config["subscriber overflow"]
+    cfg_avr_output_port = config["avr output port"]
+    cfg_beast_output_port = config["beast output port"]
+    cfg_sbs_output_port = config["sbs output port"]
+    cfg_output_buffer = config["output buffer"]
     cfg_flight_db_name = config["flight db name"]
     cfg_use_flight_db = True if cfg_flight_db_name != "" else False
     cfg_config_file = config["config file"]
     cfg_use_email = True if cfg_config_file != "" else False
     cfg_email_recipient = config["email recipient"]
     cfg_stats_filename = config["statistics filename"]
+    cfg_demod_workers = config["demod workers"]
+    cfg_overload_policy = config["overload policy"]
+    cfg_overload_priority_df = set(config["overload priority df"])
+
+    _syndrome_tables = {}  # Built by _syndrome_table, shared by all instances
 
     def __init__(self):
         pass
@@ -343,7 +392,7 @@ class ADSB:
                     scale = msg[ind + 2] * scale_down / self.MODES_SIG_QUARTER
                     msg[ind + 2] = self.MODES_SIGMAX if (scale > self.MODES_SIGMAX) else scale
 
-    def _detect_adsb(self, sig):
+    def _detect_adsb(self, sig, start=0):
         """
             The preamble should ideally look like this
     
@@ -352,21 +401,33 @@ class ADSB:
         low       * * * * * * * * * * *  *  *  *  * 
         bit nr    0 1 2 3 4 5 6 7 8 9 10 11 12 13 14
     
-        :param sig: 
-        :return: 
+        Scanning stops SQUITTER_LONG_MAX_SIZE samples before the end of sig, the index where the scan stopped is
+        returned so that the caller can continue the scan at the right sample when more samples are available.
+
+        :param sig: magnitude samples, a list or a numpy array
+        :param start: index of the first sample to scan
+        :return: list of [signal strength, message], list of sample index per message, index where scan stopped
         """
+        if np is not None and isinstance(sig, np.ndarray) and not self.cfg_check_phase:
+            return self._detect_adsb_batch(sig, start)
+
+        if not isinstance(sig, list):
+            sig = sig.tolist()  # The scan below indexes single samples, which is faster on a list than on an array
+
         arr = []
+        positions = []
         max_length = len(sig) - self.SQUITTER_LONG_MAX_SIZE
-        ind = 0
+        ind = start
         while ind < max_length:
             if self._detect_preamble(sig, ind):
                 sig_strength = self._preamble_signal_strength(sig[ind: ind + self.PREAMBLE_SAMPLES])
                 arr.append([sig_strength, sig[ind:ind + self.SQUITTER_LONG_MAX_SIZE]])
+                positions.append(ind)
 
                 # Determine if we have found a long or short squitter and increment ind accordingly
+                # The most significant bit of the downlink format, ie the first bit, indicates the length
                 msg = self._data_to_long(sig[ind:ind + self.SQUITTER_LONG_MAX_SIZE])
-                downlink_format = (int(hex(msg)[2:4], base=16) & 0xF8) >> 3
-                if downlink_format & 0x10:
+                if msg >> (self.MODES_LONG_MSG_BITS - 1):
                     ind += self.SQUITTER_LONG_MAX_SIZE
                 else:
                     ind += self.SQUITTER_SHORT_MAX_SIZE
@@ -381,114 +442,156 @@ class ADSB:
                         if self._detect_preamble(sig, ind):
                             sig_strength = self._preamble_signal_strength(sig[ind: ind + self.PREAMBLE_SAMPLES])
                             arr.append([sig_strength, sig[ind:ind + self.SQUITTER_LONG_MAX_SIZE]])
+                            positions.append(ind)
             ind += 1
         # NB _data_to_long transformation will skip the preamble samples
-        return [[arr[ind][0], self._data_to_long(arr[ind][1])] for ind in range(len(arr))]
+        return [[elem[0], self._data_to_long(elem[1])] for elem in arr], positions, ind
 
-    def _hex_str_2_bin_str(self, hexstr):
+    def _detect_adsb_batch(self, sig, start=0):
         """
-        Convert a hexdecimal string to binary string, with zero fillings. 
-        If the hex string have a trailing 'L' (Long) it is removed
+        Same as _detect_adsb with the same parameters, but sig is a numpy array.
+        The preamble conditions are evaluated for all samples at once (_detect_preambles), only the candidates found
+        are visited one by one to skip past the detected messages, in the same way as _detect_adsb does.
+        The messages are returned as a FrameBatch rather than a list.
         """
-        hexstr = hexstr.rstrip('L').lstrip('0x')
-        # We have a long (112 bits, 14 bytes message => 28 hex string)
-        # Pad hexstring with zero's (to the left) to ensure right length
-        if len(hexstr) > (2 * self.MODES_SHORT_MSG_BYTES):
-            hexstr = hexstr.zfill(self.MODES_LONG_MSG_BYTES * 2)
-        else:
-            hexstr = hexstr.zfill(self.MODES_SHORT_MSG_BYTES * 2)
+        candidates, long_msgs = self._detect_candidates(sig, start)
+        keep, ind = self._skip_detected(candidates.tolist(), long_msgs.tolist(), start)
 
-        return bin(int(hexstr, base=16))[2:].zfill(len(hexstr) * 4)
+        pos_arr = candidates[np.array(keep, dtype=np.intp)]
+        frames = FrameBatch(self._preamble_signal_strengths(sig, pos_arr), self._slice_frames(sig, pos_arr), pos_arr)
+        return frames, pos_arr.tolist(), max(ind, len(sig) - self.SQUITTER_LONG_MAX_SIZE)
 
-    def _alt_crc_func(self, msg):
-        """    
-        Mode-S Cyclic Redundancy Check
-        Detect if bit error occurs in the Mode-S message
-        Args:
-            msg (string): 28 bytes hexadecimal message string 
-        Returns:
-            hex string: message checksum
+    def _detect_candidates(self, sig, start=0):
         """
-        if msg == '0':
-            return msg
-
-        bin_list = list(self._hex_str_2_bin_str(msg))
-
-        crc_val = 0
-        offset = 0 if len(bin_list) == self.MODES_LONG_MSG_BITS else self.MODES_SHORT_MSG_BITS
+        All indexes from start where a preamble is detected (_detect_preambles) and whether the message is long or not
+        """
+        candidates = self._detect_preambles(sig, start)
+        # The first bit is high for long squitters
+        long_msgs = sig[candidates + self.MODES_DATA_OFFSET] > sig[candidates + self.MODES_DATA_OFFSET + 1]
+        return candidates, long_msgs
 
-        for i in range(len(bin_list) - 24):
-            if bin_list[i] == '1':
-                crc_val ^= self.MODES_CHECKSUM_TABLE[i + offset]
+    def _skip_detected(self, candidates, long_msgs, start=0):
+        """
+        Visit the candidates (lists) from start one by one, skipping the candidates within a detected message.
+        Returns a list with the indexes of the detected candidates and the index after the last detected message
+        """
+        keep = []
+        ind = start
+        for num, (pos, long_msg) in enumerate(zip(candidates, long_msgs)):
+            if pos < ind:
+                continue  # This candidate is within the message detected before
+            keep.append(num)
+            ind = pos + (self.SQUITTER_LONG_MAX_SIZE if long_msg else self.SQUITTER_SHORT_MAX_SIZE)
+        return keep, ind
+
+    def _slice_frames(self, sig, positions):
+        """
+        Gather the data samples of all messages starting at positions into a (N, 224) matrix, compare the even and odd
+        columns (manchester coding, high to low is 1) and pack the bits into a (N, 14) uint8 array.
+        This is _data_to_long for many messages at once, with bytes instead of a long as result.
+        """
+        offsets = positions[:, None] + (self.MODES_DATA_OFFSET + np.arange(self.MODES_LONG_MSG_SAMPLES))
+        samples = sig[offsets]
+        return np.packbits(samples[:, 0::2] > samples[:, 1::2], axis=1)
 
-        check_sum = int(self._bin_list_2_hex_str(bin_list[-24:]), base=16)
-        result = (crc_val ^ check_sum) & 0x00FFFFFF
-        return hex(result)[2:]
+    def _preamble_signal_strengths(self, sig, positions):
+        """
+        _preamble_signal_strength for the preambles starting at positions, returns a list
+        """
+        preambles = sig[positions[:, None] + np.arange(14)]
+        diffs = (preambles.max(axis=1) - preambles.min(axis=1)).tolist()
+        return [round((diff / float(self.MODES_SIGMAX)) * 100, 1) for diff in diffs]
 
-    def _crc_func(self, msg):
+    def crc(self, msg, no_of_bits=MODES_LONG_MSG_BITS):
         """
         Mode-S Cyclic Redundancy Check
-        Detect if bit error occurs in the Mode-S message
+        Detect if bit error occurs in the Mode-S message, the crc of the data bits is computed byte by byte using
+        MODES_CRC_TABLE and xor'ed with the parity (the last 24 bits).
+        :param msg: the message, integer
+        :param no_of_bits: length of the message, 56 or 112
+        :return: the syndrome, integer. Zero if no bit errors were detected, for messages where the parity is overlaid
+                 with the ICAO address the syndrome is the address
         """
-        # the polynominal generator code for crc_sum
+        crc = 0
+        for shift in range(no_of_bits - 8, 23, -8):
+            crc = ((crc << 8) & 0xFFFFFF) ^ self.MODES_CRC_TABLE[((crc >> 16) ^ (msg >> shift)) & 0xFF]
+        return crc ^ (msg & 0xFFFFFF)
 
-        if msg == '0':
-            return msg
-
-        bin_list = list(self._hex_str_2_bin_str(msg))
+    def crc_bytes(self, msg):
+        """
+        Same as crc, msg is the message as bytes (bytearray or a numpy array row), 7 or 14 bytes
+        """
+        crc = 0
+        for byte in msg[:-3]:
+            crc = ((crc << 8) & 0xFFFFFF) ^ self.MODES_CRC_TABLE[((crc >> 16) ^ byte) & 0xFF]
+        return crc ^ ((msg[-3] << 16) | (msg[-2] << 8) | msg[-1])
 
-        # msgbin[-24:] = ['0'] * 24 if encode else None
+    @classmethod
+    def crc_batch(cls, frames):
+        """
+        Same as crc for many messages, frames is a (N, 14) numpy uint8 array (see FrameBatch).
+        Short messages (first bit is 0) use the first 7 bytes.
+        :return: numpy uint32 array with the syndromes
+        """
+        table = np.array(cls.MODES_CRC_TABLE, dtype=np.uint32)
+        frames = frames.astype(np.uint32)
 
-        # loop all bits, except last 24 parity bits
-        for i in range(len(bin_list) - 24):
-            # if 1, perform modulo 2 multiplication,
-            if bin_list[i] == '1':
-                for j in range(len(self.GENERATOR)):
-                    # modulo 2 multiplication = XOR
-                    bin_list[i + j] = str((int(bin_list[i + j]) ^ int(self.GENERATOR[j])))
+        def parity(ind):
+            return (frames[:, ind] << 16) | (frames[:, ind + 1] << 8) | frames[:, ind + 2]
 
-        # last 24 bits
-        return self._bin_list_2_hex_str(bin_list[-24:])
+        crc = np.zeros(len(frames), dtype=np.uint32)
+        short_crc = crc
+        for ind in range(cls.MODES_LONG_MSG_BYTES - 3):
+            if ind == cls.MODES_SHORT_MSG_BYTES - 3:
+                short_crc = crc ^ parity(ind)  # All data bytes of short messages are shifted in
+            crc = ((crc << 8) & 0xFFFFFF) ^ table[((crc >> 16) ^ frames[:, ind]) & 0xFF]
 
-    def crc(self, msg):
-        """
-        Calls the crc function in use, either _alt_crc_func or _crc_func
-        """
-        return self._alt_crc_func(msg)
+        return np.where(frames[:, 0] & 0x80, crc ^ parity(cls.MODES_LONG_MSG_BYTES - 3), short_crc).astype(np.uint32)
 
-    def correct_biterror(self, msg, bits=1):
+    def correct_biterror(self, msg, no_of_bits, bits=1, syndrome=None):
         """
-        Tries to correct bit errors by flipping one bit at a time in msg and calculate a new crc_sum.
-        If the new crc_sum is zero we have corrected the error and return the corrected string
-    
-        Default is to do this on 1 bit (bits defaults to 1), if bits is 2 try to do it on 2 bits instead.
-        If bits equals 2 this is a VERY time consuming process and should not be used.
-        :param msg: The message to be checked, hex string
-        :param bits: No of bits to be corrected
+        Tries to correct bit errors by looking up the syndrome of msg among the syndromes of all 1 bit errors
+        (or all 1 and 2 bit errors if bits is 2). The crc is linear so the syndrome of a message with bit errors is
+        the syndrome of the error pattern, flipping the bits of the pattern found gives the corrected message.
+        :param msg: The message to be checked, integer
+        :param no_of_bits: length of the message, 56 or 112
+        :param bits: No of bits to be corrected, 1 or 2
+        :param syndrome: crc syndrome of msg if already computed
         :return: a corrected message or None
         """
         if bits != 1 and bits != 2:
             return None
 
-        bin_str = self._hex_str_2_bin_str(msg)
-        bin_list = list(bin_str)
-        # msgbin = list(hex_str_2_bin_str(msg))
+        if syndrome is None:
+            syndrome = self.crc(msg, no_of_bits)
+        error = self._syndrome_table(no_of_bits, bits).get(syndrome)
+        return msg ^ error if error is not None else None
 
-        for i in range(5, len(bin_list)):
-            bin_list[i] = '0' if bin_list[i] == '1' else '1'  # Flip bit
-            if bits == 1:
-                res = self._bin_list_2_hex_str(bin_list)
-                if self.crc_2_int(self.crc(res)) == 0:  # We found that crc_sum is Ok with this bit flip
-                    return int(res)  # Return the corrected message
-            else:
-                for j in range(i + 1, len(bin_list)):
-                    bin_list[j] = '0' if bin_list[j] == '1' else '1'  # Flip bit
-                    res = self._bin_list_2_hex_str(bin_list)
-                    if self.crc_2_int(self.crc(res)) == 0:
-                        return int(res)  # Return the corrected message
-                    bin_list[j] = '0' if bin_list[j] == '1' else '1'  # Flip bit back
-            bin_list[i] = '0' if bin_list[i] == '1' else '1'  # Flip bit back
-        return None
+    def _syndrome_table(self, no_of_bits, bits):
+        """
+        Returns a dictionary {syndrome: error pattern} for all errors of 1 bit (bits is 1) or 1 and 2 bits (bits is 2)
+        in a message of no_of_bits. Bits are counted from the most significant bit, the first 5 bits (downlink
+        format) are not included. A syndrome shared by different 2 bit errors can't be corrected and is left out.
+        The table is built the first time it is needed.
+        """
+        key = (no_of_bits, bits)
+        if key not in self._syndrome_tables:
+            errors = [1 << (no_of_bits - 1 - i) for i in range(5, no_of_bits)]
+            table = {self.crc(error, no_of_bits): error for error in errors}
+            if bits == 2:
+                ambiguous = set()
+                for i, error_i in enumerate(errors):
+                    for error_j in errors[i + 1:]:
+                        syndrome = self.crc(error_i ^ error_j, no_of_bits)
+                        if syndrome in table:
+                            if bin(table[syndrome]).count('1') == 2:
+                                ambiguous.add(syndrome)  # Keep a 1 bit error as the more likely one
+                        else:
+                            table[syndrome] = error_i ^ error_j
+                for syndrome in ambiguous:
+                    del table[syndrome]
+            ADSB._syndrome_tables[key] = table
+        return self._syndrome_tables[key]
 
     def _preamble_signal_strength(self, sig):
         """
@@ -561,19 +664,120 @@ class ADSB:
                 return True
         return False
 
-    @staticmethod
-    def crc_2_int(crc_sum):
+    def _detect_preambles(self, sig, start=0):
+        """
+        Vectorised version of _detect_preamble, the conditions are evaluated as masks over the numpy array sig.
+        Returns the indexes, from start and below len(sig) - SQUITTER_LONG_MAX_SIZE, where a preamble is detected
+        """
+        end = len(sig) - self.SQUITTER_LONG_MAX_SIZE
+        if end <= start:
+            return np.empty(0, dtype=np.intp)
+
+        sig = sig.astype(np.int32)  # The sum of samples below would overflow unsigned shorts
+
+        def s(k):
+            # s(k)[i] is the sample sig[ind + k] for index ind = start + i
+            return sig[start + k:end + k]
+
+        mask = (s(0) > s(1)) & (s(1) < s(2)) & (s(2) > s(3)) & (s(3) < s(0)) & (s(4) < s(0)) & (s(5) < s(0)) & \
+            (s(6) < s(0)) & (s(7) > s(8)) & (s(8) < s(9)) & (s(9) > s(6))
+
+        high = (s(0) + s(2) + s(7) + s(9)) // 6
+        mask &= (s(4) < high) & (s(5) < high) & (s(11) < high) & (s(12) < high) & (s(13) < high) & (s(14) < high)
+
+        return np.flatnonzero(mask) + start
+
+
+class FrameBatch:
+    """
+    The messages detected in one buffer of samples, kept as arrays
+
+        signal_strength: list with the signal strength of each message, see ADSB._preamble_signal_strength
+        frames: the messages as a (N, 14) numpy uint8 array, short messages use the first 7 bytes
+        positions: numpy array with the sample index in the buffer where each message starts
+        timestamps: list with the time of each message in ticks of a 12 MHz clock, None until set by the tuner
+
+    Iterating over a batch gives [signal strength, message, crc syndrome] with message as a long, the first two are the
+    same items as in the list returned by the scalar detection, followed by the timestamp when set. The syndromes are
+    computed for the whole batch at once. Consumers that can use the arrays directly use the attributes.
+    """
+
+    def __init__(self, signal_strength, frames, positions, timestamps=None):
+        self.signal_strength = signal_strength
+        self.frames = frames
+        self.positions = positions
+        self.timestamps = timestamps
+        self._msgs = None
+        self._syndromes = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        if self.timestamps is None:
+            items = zip(self.signal_strength, self.msgs(), self.syndromes())
+        else:
+            items = zip(self.signal_strength, self.msgs(), self.syndromes(), self.timestamps)
+        for item in items:
+            yield list(item)
+
+    def syndromes(self):
+        """
+        The crc syndrome of each message as a list of integers, see ADSB.crc_batch
+        """
+        if self._syndromes is None:
+            self._syndromes = ADSB.crc_batch(self.frames).tolist()
+        return self._syndromes
+
+    def msgs(self):
+        """
+        The messages as longs, each 7 byte half of the frames is combined into an unsigned 64-bit integer at once
+        """
+        if self._msgs is None:
+            frames = self.frames.astype(np.uint64)
+            high = np.zeros(len(frames), dtype=np.uint64)
+            low = np.zeros(len(frames), dtype=np.uint64)
+            for ind in range(ADSB.MODES_SHORT_MSG_BYTES):
+                high = (high << np.uint64(8)) | frames[:, ind]
+                low = (low << np.uint64(8)) | frames[:, ind + ADSB.MODES_SHORT_MSG_BYTES]
+            self._msgs = [(h << ADSB.MODES_SHORT_MSG_BITS) | l for h, l in zip(high.tolist(), low.tolist())]
+        return self._msgs
+
+    def downlink_formats(self):
         """
-        Convert the crc_sum hex-string to integer
+        The downlink format of each message, top 5 bits of the first byte
         """
-        return int(crc_sum.rstrip('L'), base=16)
+        return self.frames[:, 0] >> 3
 
     @staticmethod
-    def _bin_list_2_hex_str(bin_list):
+    def concat(batches):
         """
-        Convert a list of binaries to a hexadecimal string
+        One batch with the messages of all batches, the positions refer to the buffer of each message
         """
-        return hex(int(''.join(bin_list), 2))[2:]
+        batch = FrameBatch([strength for elem in batches for strength in elem.signal_strength],
+                           np.concatenate([elem.frames for elem in batches]),
+                           np.concatenate([elem.positions for elem in batches]))
+        if all(elem.timestamps is not None for elem in batches):
+            batch.timestamps = [timestamp for elem in batches for timestamp in elem.timestamps]
+        if all(elem._msgs is not None for elem in batches):
+            batch._msgs = [msg for elem in batches for msg in elem._msgs]
+        if all(elem._syndromes is not None for elem in batches):
+            batch._syndromes = [syndrome for elem in batches for syndrome in elem._syndromes]
+        return batch
+
+    def select(self, keep):
+        """
+        A new batch with the messages at the indexes in keep, messages and syndromes already computed are kept
+        """
+        rows = np.array(keep, dtype=np.intp)
+        batch = FrameBatch([self.signal_strength[ind] for ind in keep], self.frames[rows], self.positions[rows])
+        if self.timestamps is not None:
+            batch.timestamps = [self.timestamps[ind] for ind in keep]
+        if self._msgs is not None:
+            batch._msgs = [self._msgs[ind] for ind in keep]
+        if self._syndromes is not None:
+            batch._syndromes = [self._syndromes[ind] for ind in keep]
+        return batch
 
 
 class RepeatTimer(threading.Thread):
@@ -645,8 +849,31 @@ class Stats:
             'latest_start_time': 0,
             'latest_start_time_string': "",
             'valid_preambles': 0,
+            'carry_over_frames': 0,
             'valid_crc': 0,
             'not_valid_crc': 0,
+            'corrected_1_bit': 0,
+            'corrected_2_bit': 0,
+            'not_corrected': 0,
+            'shed_buffers': 0,
+            'shed_frames': 0,
+            'max_backlog': 0,
+            'blips': 0,
+            'max_blips': 0,
+            'expired_blips': 0,
+            'blip_expiry_rate': 0.0,
+            'msgq_depth': 0,
+            'msgq_max_depth': 0,
+            'msgq_batch_size': 0.0,
+            'msgq_max_batch_size': 0,
+            'msgq_full': 0,
+            'server_connections': 0,
+            'server_requests': 0,
+            'subscribers': 0,
+            'subscriber_messages': 0,
+            'subscriber_dropped': 0,
+            'subscriber_disconnects': 0,
+            'output_dropped': 0,
             'df_0': 0,
             'df_1': 0,
             'df_2': 0,
@@ -687,6 +914,10 @@ class Stats:
             'max_lon': -180,
             'min_lon': 180
             }
+    # The current state rather than counts, not carried over from the stats file of the previous run. output_ports and
+    # demod_workers are set at runtime by the server and the tuner
+    GAUGES = ('blips', 'blip_expiry_rate', 'msgq_depth', 'msgq_batch_size', 'server_connections', 'subscribers',
+              'output_ports', 'demod_workers')
     icao_list = []
     flight_list = {}
 
@@ -699,7 +930,9 @@ class Stats:
 
         if os.path.exists(location):
             try:
-                self.data = simplejson.load(open(self.loc, 'rb'))
+                # Start from the defaults so that keys added since the file was written are present
+                self.data = dict(Stats.data)
+                self.data.update(simplejson.load(open(self.loc, 'rb')))
             except simplejson.JSONDecodeError:
                 try:
                     self.logger.info("Init, stats file corrupt, using backup")
@@ -709,6 +942,12 @@ class Stats:
                     # No joy, give up and use default values
                     self.logger.info("Init, DB file and backup corrupt, using defaults")
 
+            for key in self.GAUGES:
+                if key in Stats.data:
+                    self.data[key] = Stats.data[key]
+                else:
+                    self.data.pop(key, None)
+
         self['spots_version'] = ADSB.VERSION
         self['latest_start_time'] = time.time()
         self['latest_start_time_string'] = time.ctime(self['latest_start_time'])
@@ -718,6 +957,11 @@ class Stats:
         if self['start_time_string'] == "":
             self['start_time_string'] = self['latest_start_time_string']
 
+        # Per downlink format counters, indexed by the DF. Counted for every message so kept out of the dictionary,
+        # sync_counters writes them back into data before it is shown or stored
+        self.df_counts = array.array('L', [self['df_{}'.format(df)] for df in range(32)])
+        self.df_total = self['df_total']
+
     def __setitem__(self, key, value):
         self.data[key] = value
 
@@ -736,7 +980,21 @@ class Stats:
             self.flight_list[call_sign] = 1
         self['flights'] += 1
 
+    def count_df(self, downlink_format):
+        self.df_counts[downlink_format] += 1
+        self.df_total += 1
+
+    def sync_counters(self):
+        for df, count in enumerate(self.df_counts):
+            self.data['df_{}'.format(df)] = count
+        self.data['df_total'] = self.df_total
+
+    def get_data(self):
+        self.sync_counters()
+        return self.data
+
     def dump(self):
+        self.sync_counters()
         if os.path.isfile(self.loc):
             shutil.copy2(self.loc, self.loc_bck)  # Make a backup
 
@@ -744,10 +1002,31 @@ class Stats:
             simplejson.dump(self.data, stat_file, skipkeys=True, indent=4*' ')
 
     def __str__(self):
+        self.sync_counters()
         st = "\n"
         st += "Preambles:{}\n".format(self['valid_preambles'])
+        st += "Carry over frames:{}\n".format(self['carry_over_frames'])
         st += "Valid CRC:{}\n".format(self['valid_crc'])
         st += "Non valid CRC:{}\n".format(self['not_valid_crc'])
+        st += "Corrected 1 bit:{} 2 bits:{} not corrected:{}\n".format(self['corrected_1_bit'],
+                                                                       self['corrected_2_bit'],
+                                                                       self['not_corrected'])
+        st += "Shed buffers:{} frames:{} max backlog:{}\n".format(self['shed_buffers'],
+                                                                  self['shed_frames'],
+                                                                  self['max_backlog'])
+        st += "Blips:{} max:{} expired:{} ({:.3f}/s)\n".format(self['blips'], self['max_blips'], self['expired_blips'],
+                                                               self['blip_expiry_rate'])
+        st += "Message queue depth:{} max:{} batch size:{:.1f} max:{} full:{}\n".format(self['msgq_depth'],
+                                                                                        self['msgq_max_depth'],
+                                                                                        self['msgq_batch_size'],
+                                                                                        self['msgq_max_batch_size'],
+                                                                                        self['msgq_full'])
+        st += "Server connections:{} requests:{}\n".format(self['server_connections'], self['server_requests'])
+        st += "Subscribers:{} messages:{} dropped:{} disconnects:{}\n".format(self['subscribers'],
+                                                                            self['subscriber_messages'],
+                                                                            self['subscriber_dropped'],
+                                                                            self['subscriber_disconnects'])
+        st += "Output ports dropped batches:{}\n".format(self['output_dropped'])
         st += "Decoded messages: "
         st += "\n"
         st += "DF0: {} ".format(self['df_0'])
@@ -796,4 +1075,102 @@ class Stats:
         return st
 
 
+class BudgetMonitor:
+    """
+    Measures the wall time the stages of the sample pipeline spend per tuner buffer, against the real time the buffer
+    covers (MODES_DATA_LEN / 2 samples at 2 MSPS is 65.5 ms). If the stages together take longer the pipeline falls
+    behind and the tuner queue fills up.
+
+    Stages are added from any thread with add or add_stages:
+        uint: IQ bytes to words (in pool mode, copying the buffer to shared memory)
+        magnitude: words to magnitudes, _iq_to_uint
+        detect: preamble detection and slicing of messages, _detect_adsb
+        demod_workers: in pool mode, the busy time of the workers divided by the number of workers
+        parse: creating and parsing Squitter objects, including crc
+        blip_add: decoding and adding messages to the blips, Radar._blip_add
+    The tuner calls buffer_done with the duration of each buffer it has queued, all time added since the previous
+    buffer is accounted to that buffer. Thus parse and blip_add, run by other threads, are accounted to the buffer
+    queued after them.
+
+    Kept are:
+        last: ms per stage, and total, for the latest buffer
+        headroom: 1 - total / duration for the latest buffer, negative when it took longer than real time
+        lag: seconds the pipeline is behind real time, grows when a buffer takes longer than its duration and goes
+             back to 0 when later buffers take less
+        fell_behind: number of buffers that took longer than their duration
+        histogram: number of buffers per ms bucket for each stage, the last bucket counts the rest
+    """
+
+    STAGES = ('uint', 'magnitude', 'detect', 'demod_workers', 'parse', 'blip_add')
+    BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = dict.fromkeys(self.STAGES, 0.0)
+        self.used = set()
+        self.buffers = 0
+        self.duration = 0.0
+        self.last = {}
+        self.headroom = 1.0
+        self.min_headroom = 1.0
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.fell_behind = 0
+        self.histogram = {stage: [0] * (len(self.BUCKETS_MS) + 1) for stage in self.STAGES + ('total',)}
+
+    def add(self, stage, seconds):
+        self.lock.acquire()
+        self.current[stage] += seconds
+        self.lock.release()
+
+    def add_stages(self, **stages):
+        self.lock.acquire()
+        for stage, seconds in stages.items():
+            self.current[stage] += seconds
+        self.lock.release()
+
+    def buffer_done(self, duration):
+        """
+        Account the time added since the previous buffer to a buffer covering duration seconds
+        """
+        self.lock.acquire()
+        stages = self.current
+        self.current = dict.fromkeys(self.STAGES, 0.0)
+        stages['total'] = total = sum(stages.values())
+
+        self.used.update(stage for stage, seconds in stages.items() if seconds > 0.0)
+        for stage, seconds in stages.items():
+            self.histogram[stage][bisect.bisect_left(self.BUCKETS_MS, seconds * 1000.0)] += 1
+        self.last = {stage: round(seconds * 1000.0, 2) for stage, seconds in stages.items()}
+
+        self.buffers += 1
+        self.duration = duration
+        self.headroom = 1.0 - total / duration if duration > 0.0 else 0.0
+        self.min_headroom = min(self.min_headroom, self.headroom)
+        self.lag = max(0.0, self.lag + total - duration)
+        self.max_lag = max(self.max_lag, self.lag)
+        if total > duration:
+            self.fell_behind += 1
+        self.lock.release()
+
+    def get(self):
+        """
+        The gauges as a dictionary, stages never used are left out
+        """
+        self.lock.acquire()
+        res = {'buffers': self.buffers,
+               'buffer_ms': round(self.duration * 1000.0, 2),
+               'last_ms': {stage: ms for stage, ms in self.last.items() if stage in self.used},
+               'headroom': round(self.headroom, 3),
+               'min_headroom': round(self.min_headroom, 3),
+               'lag': round(self.lag, 3),
+               'max_lag': round(self.max_lag, 3),
+               'fell_behind': self.fell_behind,
+               'histogram_buckets_ms': list(self.BUCKETS_MS),
+               'histogram': {stage: list(counts) for stage, counts in self.histogram.items() if stage in self.used}}
+        self.lock.release()
+        return res
+
+
 statistics = Stats()
+budget = BudgetMonitor()
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
-from flask import Flask
+from flask import Flask, request
 import socket
+import struct
+import threading
 import datetime
 
 
@@ -12,52 +14,106 @@ cfg_server_address = 'localhost'
 cfg_server_port = 5051
 
 
-def get_msg(message):
+FRAME_HEADER = struct.Struct('!I')  # As in server.py
+UNAVAILABLE = '{"error": "spots server unavailable"}'
+connection = threading.local()  # One persistent connection to the server per thread
+
+
+def timestamp():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def connect():
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     except socket.error as msg:
-        print "{} Sock err (1): {}".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), msg)
-        sock = None
+        print "{} Sock err (1): {}".format(timestamp(), msg)
         return None
 
     try:
         sock.connect((cfg_server_address, cfg_server_port))
     except socket.error as msg:
-        print "{} Sock err (2): {}".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), msg)
-        sock = None
+        print "{} Sock err (2): {}".format(timestamp(), msg)
+        sock.close()
         return None
 
+    return sock
+
+
+def recv_all(sock, length):
     data = []
-    try:
-        sock.sendall(message)
-        while True:
-            stream = sock.recv(1024)
-            if not stream:
-                break
-            else:
-                data.append(stream)
-        data = ''.join(data)
-    except socket.error as msg:
-        print "{} Sock err (3): {}".format(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), msg)
-    finally:
-        sock.close()
-        return data
+    while length > 0:
+        stream = sock.recv(min(length, 65536))
+        if not stream:
+            raise socket.error("connection closed by server")
+        data.append(stream)
+        length -= len(stream)
+    return ''.join(data)
+
+
+def get_msg(message):
+    """
+    Send message as a framed request on the connection of this thread and return the reply, see server.py.
+    The connection is opened on first use and again once if it has been closed since.
+    Returns "" when the server can't be reached.
+    """
+    for retry in (False, True):
+        sock = getattr(connection, 'sock', None)
+        if sock is None:
+            sock = connection.sock = connect()
+            if sock is None:
+                return ""
+
+        try:
+            sock.sendall(FRAME_HEADER.pack(len(message)) + message)
+            length = FRAME_HEADER.unpack(recv_all(sock, FRAME_HEADER.size))[0]
+            return recv_all(sock, length)
+        except socket.error as msg:
+            sock.close()
+            connection.sock = None
+            if retry:
+                print "{} Sock err (3): {}".format(timestamp(), msg)
+                return ""
+
+
+def json_reply(message):
+    """
+    The response to the client with the reply to message, 503 with a json error when the server can't be reached
+    """
+    reply = get_msg(message)
+    if reply == "":
+        return app.response_class(UNAVAILABLE, status=503, content_type='application/json')
+    return app.response_class(reply, content_type='application/json')
 
 
 @app.route("/spots/data")
 def spots_data():
-    return app.response_class(get_msg("GET DATA STR"), content_type='application/json')
+    # With ?since=n&epoch=e only the changes after sequence number n of epoch e, see GET DATA SINCE in server.py
+    since = request.args.get('since', type=int)
+    epoch = request.args.get('epoch', type=int)
+    if since is None:
+        message = "GET DATA STR"
+    elif epoch is None:
+        message = "GET DATA SINCE {}".format(since)
+    else:
+        message = "GET DATA SINCE {} {}".format(since, epoch)
+    return json_reply(message)
 
 
 @app.route("/spots/statistics")
 def spots_statistics():
-    return app.response_class(get_msg("GET STATISTICS STR"), content_type='application/json')
+    return json_reply("GET STATISTICS STR")
 
 
 @app.route("/spots/flight_db")
 def spots_flight_db():
-    return app.response_class(get_msg("GET FLIGHT_DB STR"), content_type='application/json')
+    return json_reply("GET FLIGHT_DB STR")
+
+
+@app.route("/spots/budget")
+def spots_budget():
+    return json_reply("GET BUDGET STR")
 
 
 @app.route("/spots/logfile")
@@ -0,0 +1,129 @@
+import basic
+import binascii
+import struct
+import time
+
+__author__ = 'Wolfrax'
+
+"""
+Encoding of the frames accepted by the radar into the raw formats of dump1090, for the output ports of the server.
+
+A frame is a tuple (message, number of bits, signal strength in %, timestamp in ticks of a 12 MHz clock or None), see
+Radar.run. The encoders take the frames of one tuner buffer and return them encoded as one string, which the server
+sends to all clients of the port.
+
+AVR: a line per frame, the message as hex between '*' and ';'
+Beast: a record per frame, 0x1a, the type ('2' for short and '3' for long messages), 6 bytes timestamp, 1 byte signal
+       level and the message. A 0x1a in the record (after the type) is escaped by doubling it.
+
+SBS-1 (BaseStation) lines are made from the decoded messages instead, see sbs_line:
+    MSG,<transmission type>,1,1,<ICAO24>,1,<date>,<time>,<date>,<time>,<call sign>,<altitude>,<ground speed>,<track>,
+    <latitude>,<longitude>,<vertical rate>,<squawk>,<alert>,<emergency>,<spi>,<is on ground>
+with altitude in feet, speed in knots and vertical rate in feet/min, flags are -1 (true) or 0 and fields a message
+does not carry are empty. The transmission type follows the DF, and the TC for extended squitters:
+    1: identification (TC 1-4), 2: surface position (TC 5-8), 3: airborne position (TC 9-18, 20-22),
+    4: airborne velocity (TC 19), 5: surveillance altitude (DF4, DF20), 6: surveillance identity (DF5, DF21),
+    7: air to air (DF0, DF16), 8: all call reply (DF11)
+"""
+
+BEAST_ESCAPE = '\x1a'
+BEAST_SHORT = BEAST_ESCAPE + '2'
+BEAST_LONG = BEAST_ESCAPE + '3'
+_TIMESTAMP = struct.Struct('>Q')  # The 6 lower bytes are used
+_TIMESTAMP_MASK = (1 << 48) - 1
+
+
+def encode_avr(frames):
+    return ''.join(['*{:0{}X};\n'.format(msg, bits / 4) for msg, bits, _, _ in frames])
+
+
+def encode_beast(frames):
+    records = []
+    for msg, bits, signal_strength, timestamp in frames:
+        # The signal level is a byte, spots has it in % of the max magnitude
+        level = min(255, int(round(signal_strength * 2.55)))
+        body = _TIMESTAMP.pack((timestamp or 0) & _TIMESTAMP_MASK)[2:] + chr(level) + \
+            binascii.unhexlify('{:0{}x}'.format(msg, bits / 4))
+        records.append(BEAST_LONG if bits > 56 else BEAST_SHORT)
+        records.append(body.replace(BEAST_ESCAPE, BEAST_ESCAPE + BEAST_ESCAPE))
+    return ''.join(records)
+
+
+SBS_DF_TYPES = {basic.ADSB.DF_SHORT_AIR2AIR_SURVEILLANCE_0: 7,
+                basic.ADSB.DF_SURVEILLANCE_ALTITUDE_REPLY_4: 5,
+                basic.ADSB.DF_SURVEILLANCE_IDENTITY_REPLY_5: 6,
+                basic.ADSB.DF_ALL_CALL_REPLY_11: 8,
+                basic.ADSB.DF_LONG_AIR2AIR_SURVEILLANCE_16: 7,
+                basic.ADSB.DF_COMM_BDS_ALTITUDE_REPLY_20: 5,
+                basic.ADSB.DF_COMM_BDS_IDENTITY_REPLY_21: 6}
+SBS_EMERGENCY_SQUAWKS = (0x7500, 0x7600, 0x7700)  # As parse_id13 gives them
+
+
+def sbs_type(msg):
+    """
+    The SBS transmission type of the decoded message msg, None if it has none
+    """
+    if msg.downlink_format in (basic.ADSB.DF_ADSB_MSG_17, basic.ADSB.DF_EXTENDED_SQUITTER_18):
+        tc = msg.type_code
+        if 1 <= tc <= 4:
+            return 1
+        if 5 <= tc <= 8:
+            return 2
+        if 9 <= tc <= 18 or 20 <= tc <= 22:
+            return 3
+        if tc == 19:
+            return 4
+        return None
+    return SBS_DF_TYPES.get(msg.downlink_format)
+
+
+def sbs_time(now):
+    """
+    The date and time fields of SBS lines for time now, formatted once for all lines of a batch
+    """
+    return time.strftime("%Y/%m/%d,%H:%M:%S", time.localtime(now)) + ".{:03d}".format(int(now * 1000) % 1000)
+
+
+def sbs_line(msg, track, stamp):
+    """
+    The SBS line of the decoded message msg, None if it has no transmission type.
+    track is the blip of the aircraft when msg gave it a new position, else None. stamp is from sbs_time.
+    """
+    msg_type = sbs_type(msg)
+    if msg_type is None:
+        return None
+
+    def flag(value):
+        return '-1' if value else '0'
+
+    call_sign = altitude = speed = heading = latitude = longitude = vertical_rate = squawk = ''
+    alert = emergency = spi = on_ground = ''
+
+    if msg_type == 1 and msg.call_sign is not None:
+        call_sign = msg.call_sign.strip()
+    if msg.altitude is not None and msg_type in (2, 3, 5, 6, 7):
+        altitude = str(msg.altitude)
+    if msg_type in (2, 4):
+        speed = str(int(round(msg.velocity))) if msg.velocity is not None else ''
+        heading = str(int(round(msg.heading))) if msg.heading is not None else ''
+    if msg_type in (2, 3) and track is not None:
+        # Squitter._set_position stores an exact 0.0 as None
+        latitude = '{:.5f}'.format(track.latitude) if track.latitude is not None else ''
+        longitude = '{:.5f}'.format(track.longitude) if track.longitude is not None else ''
+    if msg_type == 4 and msg.vertical_rate is not None:
+        vertical_rate = str(msg.vertical_rate)
+    if msg.squawk is not None:
+        squawk = '{:04X}'.format(msg.squawk)
+        emergency = flag(msg.squawk in SBS_EMERGENCY_SQUAWKS)
+
+    if msg_type in (5, 6) and msg.flight_status is not None:
+        # From the flight status, 1 and 3 are on ground, 2 to 4 alert and 4 and 5 spi
+        alert = flag(msg.flight_status in (2, 3, 4))
+        spi = flag(msg.flight_status in (4, 5))
+        on_ground = flag(msg.flight_status in (1, 3))
+    elif msg_type in (2, 3):
+        on_ground = flag(msg.on_ground)
+
+    return 'MSG,{},1,1,{:06X},1,{},{},{},{},{},{},{},{},{},{},{},{},{},{}\r\n'.format(
+        msg_type, msg.icao, stamp, stamp, call_sign, altitude, speed, heading, latitude, longitude, vertical_rate,
+        squawk, alert, emergency, spi, on_ground)
@@ -1,6 +1,9 @@
 import tuner
 import squitter
 import basic
+import collections
+import feeds
+import heapq
 import Queue
 import threading
 import curses
@@ -28,7 +31,7 @@ The main application initiates a tuner object and a radar object. The tuner runs
 information to the radar object through a callback function (Radar - tuner_read).
 
 The tuner_read method creates a Squitter object, do some basic parsing of the message and stores it into a 
-message queue (msgQ). The message passed from the tuner is in the format 
+message queue (msgQ), all messages of a tuner buffer as one batch. The message passed from the tuner is in the format 
 
     [[signal strength (float), message (long)], [signal strength, message], ...]
 
@@ -38,17 +41,22 @@ message queue (msgQ). The message passed from the tuner is in the format
 
     message is the signal found by the tuner encoded as a long integer. 
 
+    When numpy is used the tuner passes a basic.FrameBatch instead, which holds the messages as an array of bytes.
+    Iterating over it gives the same [signal strength, message] items.
+
 The radar object pick up the basic Squitter objects from the message queue (msgQ), decodes it further 
 (using Squitter.py) and store the resulting Squitter object into a 'blip dictionary' using the ICAO information as key.
 
 The blip dictionary have the following format
 
     {ICAO24: [{'timestamp': ts, 'cnt': n, 'msg': message}, ...]}
+    ICAO24 is the address as an integer (Squitter.icao)
     'timestamp' is when the message was seen, 
     'cnt' is how many times a message have been seen,
     'msg' is the decoded Squitter object
 
-The blip dictionary is in turn read recurrently by a separate thread for display.
+The blip dictionary is kept by a BlipTable, which also removes the blips not seen for "max blip ttl" seconds. The blips
+are in turn read recurrently by a separate thread for display, through a snapshot of the table.
 
 To collect some (rather pointless) statistics using call signs counts a smple FlightDB class exists.
 Call sign statistics is stored into a json structure which is stored recurrently on file (file name is configurable in 
@@ -66,8 +74,9 @@ class TextDisplay:
     This implements a table text display for Squitter messages using curses
 
     Methods are:
-        add: add a new message + timestamp + count into the msgQ dictionary using ICAO address as key
-             The methods also traverse the msqQ objects to propagate message items to the latest on
+        add: add the values of a message (Squitter.formatted, strings) + timestamp + count into the msgQ dictionary
+             using ICAO address as key. The values are formatted by the caller while it holds the Radar lock, the
+             display only keeps the strings
         start: initialize the window environment
         update_screen: format and add strings to the window form the msgQ
         close: close the window environment in an orderly manner
@@ -132,7 +141,7 @@ class TextDisplay:
         self.msgQ = {}
 
     def add(self, ts, msg, cnt):
-        # msgQ = {'abc': {'msg': squitter, 'timestamp': '0', 'msg_count': '1'}, 'def':...
+        # msgQ = {'abc': {'msg': {'ICAO24': 'abc', ...}, 'timestamp': '0', 'msg_count': '1'}, 'def':...
         icao = msg['ICAO24']
         if icao in self.msgQ:
             self.msgQ[icao]['msg'].update(msg)
@@ -218,6 +227,177 @@ class FlightDB:
         self.lock.release()
 
 
+class MessageQueue:
+    """
+    The bounded queue of parsed messages from the tuner thread to the radar thread.
+
+    Messages are put and got a batch (list) at a time, one batch per tuner buffer, so the threads take the lock once
+    per buffer and not once per message. put waits while high_water messages or more are queued, the tuner then
+    falls behind and its buffer ring sheds according to the overload policy.
+    The queue depth (messages), max depth and batch size (moving average and max) are gauged in the statistics.
+    """
+
+    def __init__(self, high_water):
+        self.high_water = high_water
+        self.batches = collections.deque()
+        self.depth = 0  # Queued messages
+        self.cond = threading.Condition()
+
+    def put(self, batch, abort=None):
+        """
+        Add a batch of messages, waits for room unless abort (an Event) is set
+        """
+        with self.cond:
+            if self.depth >= self.high_water:
+                basic.statistics['msgq_full'] += 1
+                while self.depth >= self.high_water and not (abort is not None and abort.is_set()):
+                    self.cond.wait(1.0)
+
+            self.batches.append(batch)
+            self.depth += len(batch)
+
+            basic.statistics['msgq_depth'] = self.depth
+            if self.depth > basic.statistics['msgq_max_depth']:
+                basic.statistics['msgq_max_depth'] = self.depth
+            basic.statistics['msgq_batch_size'] += 0.1 * (len(batch) - basic.statistics['msgq_batch_size'])
+            if len(batch) > basic.statistics['msgq_max_batch_size']:
+                basic.statistics['msgq_max_batch_size'] = len(batch)
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Remove and return the oldest batch, raises Queue.Empty if there is none within timeout seconds
+        """
+        with self.cond:
+            if not self.batches:
+                self.cond.wait(timeout)
+            if not self.batches:
+                raise Queue.Empty
+            batch = self.batches.popleft()
+            self.depth -= len(batch)
+            basic.statistics['msgq_depth'] = self.depth
+            self.cond.notify_all()
+            return batch
+
+    def empty(self):
+        return not self.batches
+
+    def qsize(self):
+        return self.depth
+
+
+class BlipTable:
+    """
+    The blip dictionary, {ICAO24: {'timestamp': ts, 'count': n, 'msg': msg, 'json': fields, 'seq': n}, ...}, with
+    expiry of blips older than ttl. 'json' is the cached json of msg.formatted() without braces, None when msg has
+    changed.
+
+    Every add, update and expiry takes the next sequence number, 'seq' is the one of the latest add or update of the
+    blip. The last EXPIRED_LOG expiries are remembered, so changes_since can tell what happened after a sequence number.
+    The sequence numbers restart with every table, epoch (the creation time in ms) tells the tables apart.
+
+    Adding and updating a blip is O(1). For expiry there is a heap of (timestamp, ICAO24), one entry per blip: when an
+    entry is due and the blip has been seen since, the entry is pushed again with the new timestamp. So expire only
+    costs for the blips that are due, not a scan of all blips.
+
+    snapshot gives the (ICAO24, blip) items for readers, it is only rebuilt when blips are added or removed.
+    Not thread safe, Radar uses it under its lock.
+    """
+
+    EXPIRED_LOG = 4096
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.blips = {}
+        self.expiry = []  # heap of (timestamp, ICAO24)
+        self.items = None  # The snapshot
+        self.last_expire = time.time()
+        self.seq = 0  # The latest sequence number
+        self.expired = collections.deque()  # (seq, ICAO24) of the latest expiries, oldest first
+        self.oldest_seq = 0  # changes_since is complete after this sequence number
+        self.epoch = int(time.time() * 1000)
+
+    def __contains__(self, icao):
+        return icao in self.blips
+
+    def __len__(self):
+        return len(self.blips)
+
+    def add(self, icao, msg, timestamp):
+        """
+        Add msg as a new blip or update the blip of icao with msg, return the blip
+        """
+        self.seq += 1
+        blip = self.blips.get(icao)
+        if blip is None:
+            blip = self.blips[icao] = {'msg': msg, 'timestamp': timestamp, 'count': 1, 'json': None, 'seq': self.seq}
+            heapq.heappush(self.expiry, (timestamp, icao))
+            self.items = None
+            if len(self.blips) > basic.statistics['max_blips']:
+                basic.statistics['max_blips'] = len(self.blips)
+        else:
+            blip['msg'].update(msg)
+            blip['timestamp'] = timestamp
+            blip['count'] += 1
+            blip['json'] = None
+            blip['seq'] = self.seq
+        return blip
+
+    def expire(self, now):
+        """
+        Remove the blips not seen for ttl seconds
+        """
+        limit = now - self.ttl
+        expired = 0
+        while self.expiry and self.expiry[0][0] <= limit:
+            icao = self.expiry[0][1]
+            timestamp = self.blips[icao]['timestamp']
+            if timestamp <= limit:
+                heapq.heappop(self.expiry)
+                del self.blips[icao]
+                expired += 1
+                self.seq += 1
+                self.expired.append((self.seq, icao))
+            else:
+                heapq.heapreplace(self.expiry, (timestamp, icao))  # Seen since, due again ttl after that
+
+        if expired:
+            self.items = None
+            while len(self.expired) > self.EXPIRED_LOG:
+                self.oldest_seq = self.expired.popleft()[0]
+        basic.statistics['expired_blips'] += expired
+        basic.statistics['blips'] = len(self.blips)
+        if now > self.last_expire:
+            # Moving average of the expired blips per second
+            rate = expired / (now - self.last_expire)
+            basic.statistics['blip_expiry_rate'] += 0.1 * (rate - basic.statistics['blip_expiry_rate'])
+        self.last_expire = now
+
+    def snapshot(self):
+        if self.items is None:
+            self.items = tuple(self.blips.iteritems())
+        return self.items
+
+    def changes_since(self, since, epoch):
+        """
+        The changes after sequence number since, return (full, items, expired). items are the (ICAO24, blip) added or
+        updated after since and expired the ICAO24, as hex strings, of the blips expired after since. When since is too
+        old, or not a sequence number of this table (epoch is not the epoch of the table), full is True and items are
+        all blips.
+        """
+        if epoch != self.epoch or since <= self.oldest_seq or since > self.seq:
+            return True, self.snapshot(), []
+
+        items = [(icao, blip) for icao, blip in self.blips.iteritems() if blip['seq'] > since]
+        expired = set()
+        for seq, icao in reversed(self.expired):
+            if seq <= since:
+                break
+            if icao not in self.blips:  # Else it is back again
+                expired.add("{:x}".format(icao))  # As Squitter['ICAO24']
+        return False, items, list(expired)
+
+
 class Radar(basic.ADSB, threading.Thread):
     """
     The Radar class is where squitter messages are stored and processed.
@@ -234,14 +414,25 @@ class Radar(basic.ADSB, threading.Thread):
     The radar use a Text User Interface (TUI) to display information to the end user.
     """
 
+    SNAPSHOT_TICK = 1.0  # Seconds a json snapshot of the blips is served before it is rebuilt, see get_blips_json
+
     def __init__(self):
         threading.Thread.__init__(self, name="Radar")
 
         self.lock = threading.Lock()
         self.finished = threading.Event()
 
-        self.msgQ = Queue.Queue()  # msgQ is where we store messages that the tuner have detected, unlimited queue size
-        self.blips = {}  # blips is a dictionary where we keep the recently seen messages
+        self.msgQ = MessageQueue(self.cfg_msgq_high_water)  # msgQ is where we store messages that the tuner detected
+        self.blips = BlipTable(self.cfg_max_blip_ttl)  # The recently seen messages
+
+        self.snapshot_lock = threading.Lock()
+        self.snapshot = None  # The blips as json, shared by the requests within a tick
+        self.snapshot_time = 0
+        self.publisher = None  # Messages are published to subscribers when set, see server.Publisher
+        self.frame_publisher = None  # And the accepted frames of each batch to the output ports
+        self.sbs_publisher = None  # And the SBS lines of each batch
+        self.sbs_lines = None  # The SBS lines of the current batch, None when not published
+        self.sbs_stamp = None  # The date and time of the lines of the current batch
         self.screen = None
 
         self.daemon = True  # This is a daemon thread
@@ -274,7 +465,11 @@ class Radar(basic.ADSB, threading.Thread):
 
     @staticmethod
     def get_statistics():
-        return basic.statistics.data
+        return basic.statistics.get_data()
+
+    @staticmethod
+    def get_budget():
+        return basic.budget.get()
 
     def get_blips_serialized(self):
         # blips_series: {{'count': x, 'timestamp': y, 'altitude': 0, 'longitude': 13.755, ...},
@@ -283,42 +478,84 @@ class Radar(basic.ADSB, threading.Thread):
         result = []
         self.lock.acquire()
 
-        for key in self.blips.keys():
-            elem = {'count': self.blips[key]['count'],
-                    'timestamp': str(int(time.time() - self.blips[key]['timestamp']))}
-            for msg_key in self.blips[key]['msg']:
-                elem.update({msg_key: self.blips[key]['msg'][msg_key]})
+        now = time.time()
+        for _, blip in self.blips.snapshot():
+            elem = {'count': blip['count'], 'timestamp': str(int(now - blip['timestamp']))}
+            elem.update(blip['msg'].formatted())
             result.append(elem)
 
         self.lock.release()
         return result
 
+    def get_blips_json(self):
+        """
+        The blips serialized as json, as get_blips_serialized.
+
+        The snapshot is built at most once per SNAPSHOT_TICK, all requests within the tick get the same string.
+        The json of the values of a blip is cached until the blip is updated, for the others only the count and
+        timestamp are formatted.
+        """
+        with self.snapshot_lock:
+            now = time.time()
+            if self.snapshot is None or now - self.snapshot_time >= self.SNAPSHOT_TICK:
+                self.lock.acquire()
+                fragments = [self._blip_json(blip, now) for _, blip in self.blips.snapshot()]
+                self.lock.release()
+                self.snapshot = '[' + ', '.join(fragments) + ']'
+                self.snapshot_time = now
+            return self.snapshot
+
+    def get_blips_since(self, since, epoch=None):
+        """
+        The blips added, updated or expired after sequence number since of epoch, serialized as json:
+            {"epoch": e, "seq": n, "full": false, "aircraft": [blip, ...], "expired": [ICAO24, ...]}
+        epoch and seq are what to ask from next time, the blips are as get_blips_serialized. When since is too old, or
+        epoch is another (the radar has been restarted), full is true and aircraft are all blips, as for the first
+        request with since = 0.
+        Note that the timestamp (seconds since seen) of a blip is only sent when the blip is updated.
+        """
+        now = time.time()
+        self.lock.acquire()
+
+        full, items, expired = self.blips.changes_since(since, epoch)
+        fragments = [self._blip_json(blip, now) for _, blip in items]
+        seq = self.blips.seq
+
+        self.lock.release()
+        return '{{"epoch": {}, "seq": {}, "full": {}, "aircraft": [{}], "expired": {}}}'.format(
+            self.blips.epoch, seq, simplejson.dumps(full), ', '.join(fragments), simplejson.dumps(expired))
+
+    @staticmethod
+    def _blip_json(blip, now):
+        # Must be called with the lock held
+        if blip['json'] is None:
+            blip['json'] = simplejson.dumps(blip['msg'].formatted())[1:-1]
+        return '{{"count": {}, "timestamp": "{}", {}}}'.format(blip['count'], int(now - blip['timestamp']),
+                                                              blip['json'])
+
     def _scan_blips(self):
         """
         Scan the blip dictionary and add to the screen (if used) or print the item if screen not used
         Note that the access to the blip dictionary is locked to prevent the producer thread to modify it
         """
         self.lock.acquire()
-        self._remove_old_blips()
+        self.blips.expire(time.time())  # Remove blips that are older than max blip ttl (normally 60 secs)
 
-        for key in self.blips.keys():
+        lines = []
+        for _, blip in self.blips.snapshot():
             if self.cfg_use_text_display:
-                self.screen.add(self.blips[key]['timestamp'], self.blips[key]['msg'], self.blips[key]['count'])
+                # Formatted while we have the lock, reading the values may decode lazily decoded values
+                self.screen.add(blip['timestamp'], blip['msg'].formatted(), blip['count'])
             else:
-                print self.blips[key]['msg']
+                lines.append(str(blip['msg']))
 
         self.lock.release()
         if self.cfg_use_text_display:
             self.screen.update_screen()
             self.screen.clear_queue()
-
-    def _remove_old_blips(self):
-        """
-        Remove blips that has a timestamp older than specified level (normally 60 secs)
-        """
-        for key in self.blips.keys():
-            if (time.time() - self.blips[key]['timestamp']) >= self.cfg_max_blip_ttl:
-                del self.blips[key]
+        else:
+            for line in lines:
+                print line
 
     def _blip_add(self, msg):
         """
@@ -326,33 +563,45 @@ class Radar(basic.ADSB, threading.Thread):
         If an entry on the ICAO address exists, update the element.
 
         Note that a lock is needed before the blip dictionary is modified to avoid confusing the reader thread
+
+        With subscribers the blip is published after the update, as json. Publishing does not block.
+        For the SBS output a line of msg is added to sbs_lines.
         """
+        start = time.time()
         msg.decode()
-        icao = msg['ICAO24']
+        if self.sbs_lines is not None:
+            msg.resolve()  # The values of msg are needed now, rather than when the blip is read
+        if self.cfg_verbose_logging:
+            self.logger.info("{}".format(str(msg)))  # Before msg can be the blip, which other threads read
+        icao = msg.icao
         self.lock.acquire()
-        # blip: {ICAO24: {'timestamp': ts, 'count': n, 'msg': msg},...}
-        if icao in self.blips:
-            self.blips[icao]['msg'].update(msg)
-            self.blips[icao]['timestamp'] = time.time()
-            self.blips[icao]['count'] += 1
-        else:
-            self.blips[icao] = {'msg': msg, 'timestamp': time.time(), 'count': 1}
-
-        # if not self.blips[icao]['msg'].decodeCPR_relative():
-        #    self.blips[icao]['msg'].decodeCPR()
+        now = time.time()
+        blip = self.blips.add(icao, msg, now)
+        track = blip['msg']
 
-        if not self.blips[icao]['msg'].decodeCPR():
-            self.blips[icao]['msg'].decodeCPR_relative()
+        # The position only changes when msg carries a new even or odd position. Without a pair or a previous position
+        # local cpr decodes it against the receiver position
+        positioned = False
+        if msg.odd_time != 0 or msg.even_time != 0:
+            positioned = track.decodeCPR() or track.decodeCPR_relative() or \
+                (self.cfg_local_cpr and track.decodeCPR_local())
 
-        if basic.ADSB.cfg_use_flight_db and msg['call_sign'] != "":
-            self.flight_db.add(msg['call_sign'])
+        if self.publisher is not None and self.publisher.active:
+            self.publisher.publish(self._blip_json(blip, now))
 
         self.lock.release()
-        if self.cfg_verbose_logging:
-            self.logger.info("{}".format(str(msg)))
+
+        if self.sbs_lines is not None:
+            line = feeds.sbs_line(msg, track if positioned else None, self.sbs_stamp)  # Only this thread changes track
+            if line is not None:
+                self.sbs_lines.append(line)
+
+        if basic.ADSB.cfg_use_flight_db and msg.call_sign is not None:
+            self.flight_db.add(msg.call_sign)  # FlightDB has its own lock
+        basic.budget.add('blip_add', time.time() - start)
 
     def _blip_exist(self, msg):
-        return msg['ICAO24'] in self.blips
+        return msg.icao in self.blips
 
     def run(self):
         """
@@ -373,27 +622,44 @@ class Radar(basic.ADSB, threading.Thread):
             self.screen = TextDisplay()
 
         while not self.finished.is_set():
-            msg = self.msgQ.get()
-            if msg.get_downlink_format() == self.DF_ALL_CALL_REPLY_11:
-                if msg.crc_ok:
-                    self._blip_add(msg)
-                else:
-                    if basic.ADSB.crc_2_int(msg.crc_sum) < 80 and self._blip_exist(msg):
-                        msg.crc_ok = True
+            try:
+                msgs = self.msgQ.get(timeout=1.0)  # Timeout after 1 sec to ensure we are not blocked forever
+            except Queue.Empty:
+                continue
+
+            if self.sbs_publisher is not None and self.sbs_publisher.active:
+                self.sbs_lines = []
+                self.sbs_stamp = feeds.sbs_time(time.time())
+            else:
+                self.sbs_lines = None
+
+            for msg in msgs:
+                if msg.get_downlink_format() == self.DF_ALL_CALL_REPLY_11:
+                    if msg.crc_ok:
                         self._blip_add(msg)
-            elif msg.get_downlink_format() == self.DF_ADSB_MSG_17 and msg.crc_ok:
-                self._blip_add(msg)
-            elif msg.get_downlink_format() == self.DF_EXTENDED_SQUITTER_18 and msg.crc_ok:
-                self._blip_add(msg)
-            else:  # All other DF have CRC xor'ed with ICAO address
-                if msg.crc_ok:
+                    else:
+                        if msg.crc_sum < 80 and self._blip_exist(msg):
+                            msg.crc_ok = True
+                            self._blip_add(msg)
+                elif msg.get_downlink_format() == self.DF_ADSB_MSG_17 and msg.crc_ok:
+                    self._blip_add(msg)
+                elif msg.get_downlink_format() == self.DF_EXTENDED_SQUITTER_18 and msg.crc_ok:
                     self._blip_add(msg)
-                else:
-                    # we use the crc_sum for ICAO, this is tested in the decode method of Squitter
-                    msg['ICAO24'] = msg.crc_sum
-                    msg.crc_ok = True if self._blip_exist(msg) else False
+                else:  # All other DF have CRC xor'ed with ICAO address
                     if msg.crc_ok:
                         self._blip_add(msg)
+                    else:
+                        # we use the crc_sum for ICAO, this is tested in the decode method of Squitter
+                        msg.icao = msg.crc_sum
+                        msg.crc_ok = True if self._blip_exist(msg) else False
+                        if msg.crc_ok:
+                            self._blip_add(msg)
+
+            if self.frame_publisher is not None and self.frame_publisher.active:
+                self.frame_publisher.publish([(msg.msg, msg.no_of_bits, msg.signal_strength, msg.timestamp)
+                                              for msg in msgs if msg.crc_ok])
+            if self.sbs_lines:
+                self.sbs_publisher.publish(self.sbs_lines)
 
         self.logger.info("Radar stopping")
 
@@ -417,16 +683,21 @@ class Radar(basic.ADSB, threading.Thread):
     def tuner_read(self, msgs, stop=False):
         """
         Callback function used by the tuner thread (which is the main thread)
-        Creates a new Squitter object and do some basic parsing, add to the msgQ
+        Creates a new Squitter object and do some basic parsing, add them to the msgQ as one batch
         """
         if stop:
             self._die()
         else:
+            start = time.time()
+            batch = []
             for m in msgs:
                 sq = squitter.Squitter()
                 sq.parse(m)
                 if sq.msg != 0:
-                    self.msgQ.put(sq)
+                    batch.append(sq)
+            basic.budget.add('parse', time.time() - start)
+            if batch:
+                self.msgQ.put(batch, abort=self.finished)
 
 
 def run_Radar():
@@ -1,61 +1,510 @@
+import asyncore
+import collections
+import errno
+import fcntl
 import json
-import SocketServer
-import socket
 import logging
+import os
+import Queue
+import socket
+import struct
 import threading
+import basic
+import feeds
 
 __author__ = 'Wolfrax'
 
 """
 This implements server functionality for spots, enabling clients to access spots data over network.
 
-The Spots server implements a threaded server, one thread per request. The requests follow a simple protocol
-    "GET DATA STR": message from the client will return the radar blip messages in serialized/json format
+The Spots server is a single asyncore loop (select based) serving all client connections. The requests are executed
+by a fixed number of worker threads, "spots server max requests", which limits how many requests run at once. Each
+connection has at most one request at a time with the workers, further requests wait in its input buffer.
+
+A connection keeps open across requests, each request and reply is a frame: the length of the payload as a 4 bytes
+unsigned integer in network byte order, then the payload. An unknown request gets an empty reply.
+For compatibility a connection starting with anything but a 0 byte, as the text commands below, is a legacy one: the
+command is what is read first, there is no framing and the connection is closed after the reply (also when the command
+is unknown). A frame header starts with a 0 byte as requests are at most MAX_REQUEST bytes.
+
+The requests follow a simple protocol
+    "GET DATA STR": message from the client will return the radar blip messages in serialized/json format, the same
+                    snapshot is served to all clients within a second (see Radar.get_blips_json)
+    "GET DATA SINCE <n> <e>": message from the client will return the radar blip messages added, updated or expired
+                              after sequence number n of epoch e, together with the epoch and sequence number to ask
+                              from next time (see Radar.get_blips_since), all blips when n is 0 or too old or e is not
+                              the current epoch
     "GET STATISTICS STR": message from the client will return spots statistics in serialized/json format
     "GET FLIGHT_DB STR": message from the client will return spots flight database in serialized/json format
+    "GET BUDGET STR": message from the client will return the real-time budget of the sample pipeline (time per stage
+                      and buffer, headroom, lag and histograms) in serialized/json format
+    "SUBSCRIBE": turns the connection into a push stream, every message added by the radar is sent as the json of its
+                 blip (as in "GET DATA STR") after the update. A frame per message, or a line per message on a legacy
+                 connection. Nothing more is read from the connection. A client buffers at most "subscriber buffer"
+                 messages, when it is full new messages are dropped or the client is disconnected, see
+                 "subscriber overflow"
+
+The server also has output ports streaming the frames accepted by the radar in the raw formats of dump1090, see
+feeds.py: AVR on "avr output port" and Beast on "beast output port". And one streaming the decoded messages as SBS-1
+(BaseStation) lines on "sbs output port". Nothing is read from clients of these ports.
+The frames, or SBS lines, of each tuner buffer are published by the radar as one batch. All batches published since
+the loop last woke up are encoded once into one string, which is appended to all clients of a port. A client buffers
+at most "output buffer" bytes, when it is full batches are dropped or the client is disconnected as for subscribers.
+The counters per port are in the statistics, output_ports (frames are lines for the SBS port).
 """
 
+FRAME_HEADER = struct.Struct('!I')
+MAX_REQUEST = 1024  # Max length of a request, the commands are short
+
+
+def handle_request(radar, cmd):
+    """
+    Return the reply to the command cmd, None if the command is unknown
+    """
+    if cmd == "GET DATA STR":
+        return radar.get_blips_json()  # Already serialized
+    elif cmd.startswith("GET DATA SINCE "):
+        args = cmd[len("GET DATA SINCE "):].split()
+        try:
+            since = int(args[0])
+            epoch = int(args[1]) if len(args) > 1 else None
+        except (ValueError, IndexError):
+            since, epoch = 0, None  # All blips
+        return radar.get_blips_since(since, epoch)
+    elif cmd == "GET STATISTICS STR":
+        response = radar.get_statistics()
+    elif cmd == "GET FLIGHT_DB STR":
+        response = radar.get_flight_db()
+    elif cmd == "GET BUDGET STR":
+        response = radar.get_budget()
+    else:
+        return None
+
+    return json.dumps(response)
+
+
+class Waker(asyncore.file_dispatcher):
+    """
+    A pipe waking up the asyncore loop when a worker has a reply to write or there are messages or frames to publish,
+    then on_wake is called from the loop
+    """
+    def __init__(self, socket_map, on_wake):
+        self.on_wake = on_wake
+        self.read_fd, self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self.read_fd, map=socket_map)
+        os.close(self.read_fd)  # file_dispatcher has its own copy
+        flags = fcntl.fcntl(self.write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def wake(self):
+        try:
+            os.write(self.write_fd, 'x')
+        except OSError as e:
+            # EAGAIN, the pipe is full and the loop is woken anyway. EBADF, the server is closed
+            if e.errno not in (errno.EAGAIN, errno.EBADF):
+                raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.on_wake()
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.write_fd)
+
+
+class Publisher:
+    """
+    The hand over of messages (or batches of frames) from the Radar thread to the loop. publish never blocks: the
+    message is queued and the loop is woken, unless it is already to be woken. At most MAX_QUEUED messages are queued,
+    the oldest are dropped and counted in the statistic dropped if the loop falls behind. active is False while there
+    are no clients, so Radar need not publish.
+    """
+
+    MAX_QUEUED = 10000
+
+    def __init__(self, waker, dropped):
+        self.waker = waker
+        self.dropped = dropped
+        self.messages = collections.deque(maxlen=self.MAX_QUEUED)
+        self.lock = threading.Lock()
+        self.woken = False
+        self.active = False
+
+    def publish(self, message):
+        with self.lock:
+            if len(self.messages) == self.MAX_QUEUED:
+                basic.statistics[self.dropped] += 1
+            self.messages.append(message)
+            wake = not self.woken
+            self.woken = True
+        if wake:
+            self.waker.wake()
+
+    def take(self):
+        with self.lock:
+            messages = self.messages
+            self.messages = collections.deque(maxlen=self.MAX_QUEUED)
+            self.woken = False
+        return messages
+
+
+class Connection(asyncore.dispatcher):
+    """
+    A client connection, framed or legacy (see above). Requests are handed to the server one at a time, the connection
+    is not read while a request is with the workers or the reply is written. Replies are queued in out by the workers
+    and written by the loop.
+    """
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.socket_map)
+        self.server = server
+        self.in_buffer = ''
+        self.out = collections.deque()
+        self.out_offset = 0  # Bytes of out[0] already sent
+        self.out_lock = threading.Lock()
+        self.busy = False  # A request is with the workers
+        self.legacy = None  # Not known until something is read
+        self.subscribed = False
+        self.closed = False
+        basic.statistics['server_connections'] += 1
+
+    def readable(self):
+        return not self.busy and not self.out
+
+    def writable(self):
+        return len(self.out) > 0
+
+    def handle_read(self):
+        data = self.recv(4096)
+        if not data or self.subscribed:
+            return  # Closed by the client, or a subscriber where nothing more is read
 
-class TCPRequestHandler(SocketServer.BaseRequestHandler):
-    def handle(self):
-        cmd = self.request.recv(1024)
+        self.in_buffer += data
+        if self.legacy is None:
+            self.legacy = self.in_buffer[0] != '\x00'
 
-        if cmd == "GET DATA STR":
-            response = self.server.radar.get_blips_serialized()
-        elif cmd == "GET STATISTICS STR":
-            response = self.server.radar.get_statistics()
-        elif cmd == "GET FLIGHT_DB STR":
-            response = self.server.radar.get_flight_db()
+        if self.legacy:
+            cmd, self.in_buffer = self.in_buffer, ''
+            self.server.submit(self, cmd)
         else:
+            self._next_request()
+
+    def _next_request(self):
+        if self.busy or len(self.in_buffer) < FRAME_HEADER.size:
+            return
+
+        length = FRAME_HEADER.unpack_from(self.in_buffer)[0]
+        if length > MAX_REQUEST:
+            self.server.logger.info("Request of {} bytes from {}, closing".format(length, self.addr))
+            self.close()
+            return
+
+        end = FRAME_HEADER.size + length
+        if len(self.in_buffer) >= end:
+            cmd = self.in_buffer[FRAME_HEADER.size:end]
+            self.in_buffer = self.in_buffer[end:]
+            self.server.submit(self, cmd)
+
+    def reply(self, response):
+        """
+        The reply to the current request, called by a worker
+        """
+        if response is None:
+            response = ''
+        with self.out_lock:
+            if not self.legacy:
+                self.out.append(FRAME_HEADER.pack(len(response)))
+            self.out.append(response)
+            self.busy = False
+
+    def handle_write(self):
+        with self.out_lock:
+            data = self.out[0]
+        sent = self.send(buffer(data, self.out_offset)) if data else 0
+        self.out_offset += sent
+        if self.out_offset < len(data):
+            return
+
+        with self.out_lock:
+            self.out.popleft()
+            self.out_offset = 0
+            done = len(self.out) == 0 and not self.busy
+
+        if done and not self.subscribed:
+            if self.legacy:
+                self.close()
+            else:
+                self._next_request()  # Any request already read
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        self.server.logger.exception("Connection {}".format(self.addr))
+        self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            basic.statistics['server_connections'] -= 1
+            if self.subscribed:
+                self.server.unsubscribe(self)
+        asyncore.dispatcher.close(self)
+
+
+class StreamConnection(asyncore.dispatcher):
+    """
+    A client of an output port, the encoded batches are appended to out by the port and written as the client reads
+    """
+    def __init__(self, sock, port):
+        asyncore.dispatcher.__init__(self, sock, map=port.server.socket_map)
+        self.port = port
+        self.out = collections.deque()
+        self.out_offset = 0  # Bytes of out[0] already sent
+        self.buffered = 0  # Bytes in out not sent
+        self.closed = False
+
+    def writable(self):
+        return len(self.out) > 0
+
+    def handle_read(self):
+        self.recv(4096)  # Discarded
+
+    def handle_write(self):
+        data = self.out[0]
+        sent = self.send(buffer(data, self.out_offset))
+        self.out_offset += sent
+        self.buffered -= sent
+        self.port.stats['bytes'] += sent
+        if self.out_offset == len(data):
+            self.out.popleft()
+            self.out_offset = 0
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        self.port.server.logger.exception("Output port {} client {}".format(self.port.name, self.addr))
+        self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.port.remove(self)
+        asyncore.dispatcher.close(self)
+
+
+class StreamPort(asyncore.dispatcher):
+    """
+    An output port, the items (frames or lines) published to publisher are encoded by encode (see feeds.py) and sent
+    to all clients
+    """
+    def __init__(self, server, name, address, publisher, encode):
+        asyncore.dispatcher.__init__(self, map=server.socket_map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(16)
+
+        self.server = server
+        self.name = name
+        self.publisher = publisher
+        self.encode = encode
+        self.clients = set()
+        self.stats = {'clients': 0, 'frames': 0, 'bytes': 0, 'dropped': 0, 'disconnects': 0}
+        basic.statistics['output_ports'][name] = self.stats
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.clients.add(StreamConnection(pair[0], self))
+            self.stats['clients'] = len(self.clients)
+            self.server.update_active()
+
+    def remove(self, client):
+        self.clients.discard(client)
+        self.stats['clients'] = len(self.clients)
+        self.server.update_active()
+
+    def distribute(self, items):
+        """
+        Encode the items once and append them to the out buffer of every client
+        """
+        if not self.clients:
             return
 
-        self.request.sendall(json.dumps(response))
+        data = self.encode(items)
+        limit = basic.ADSB.cfg_output_buffer
+        self.stats['frames'] += len(items)  # Once per batch, however many clients it is sent to
+
+        for client in list(self.clients):
+            if client.buffered + len(data) > limit:
+                if basic.ADSB.cfg_subscriber_overflow == "disconnect":
+                    self.server.logger.info("Output port {} client {} too slow, disconnected".format(self.name,
+                                                                                                   client.addr))
+                    self.stats['disconnects'] += 1
+                    client.close()
+                else:
+                    self.stats['dropped'] += len(items)
+                continue
+            client.out.append(data)
+            client.buffered += len(data)
+
+    def handle_error(self):
+        self.server.logger.exception("Output port {}".format(self.name))
 
 
-class SpotsServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+class SpotsServer(asyncore.dispatcher):
     """
-    A threaded TCP server handling requests through the TCPRequestHandler.
-    It will start a new thread for each request, these are managed by the method handle
+    The asyncore TCP server accepting connections, see above. The loop runs in its own thread, started by start.
     """
     def __init__(self, server_address, radar_object):
-        SocketServer.TCPServer.allow_reuse_address = True
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
 
-        SocketServer.TCPServer.__init__(self, server_address, TCPRequestHandler)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()  # reuse a local socket in TIME_WAIT state (SO_REUSEADDR)
+        self.bind(server_address)
+        self.listen(64)
 
-        # reuse a local socket in TIME_WAIT state (SO_REUSEADDR)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.radar = radar_object
+        self.requests = Queue.Queue()  # (connection, command), at most one per connection
+        self.waker = Waker(self.socket_map, self._on_wake)
+        self.running = False
+
+        self.subscribers = set()
+        self.publisher = Publisher(self.waker, 'subscriber_dropped')
+        self.radar.publisher = self.publisher
+
+        self.frames = Publisher(self.waker, 'output_dropped')  # Batches of frames for the output ports
+        self.radar.frame_publisher = self.frames
+        self.sbs = Publisher(self.waker, 'output_dropped')  # Batches of SBS lines
+        self.radar.sbs_publisher = self.sbs
+        self.ports = []
+        basic.statistics['output_ports'] = {}
+        for name, port, publisher, encode in (('avr', basic.ADSB.cfg_avr_output_port, self.frames, feeds.encode_avr),
+                                              ('beast', basic.ADSB.cfg_beast_output_port, self.frames,
+                                               feeds.encode_beast),
+                                              ('sbs', basic.ADSB.cfg_sbs_output_port, self.sbs, ''.join)):
+            if port:
+                self.ports.append(StreamPort(self, name, (server_address[0], port), publisher, encode))
 
-        self.server_thread = threading.Thread(target=self.serve_forever)
+        self.server_thread = threading.Thread(target=self._serve)
         self.server_thread.daemon = True
         self.server_thread.name = "Socket server"
 
-        self.radar = radar_object
+        self.workers = []
+        for i in range(basic.ADSB.cfg_server_max_requests):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.name = "Server worker {}".format(i)
+            self.workers.append(worker)
+
         self.logger = logging.getLogger('spots.Server')
         self.logger.info("Message server initialized")
 
     def start(self):
+        self.running = True
+        for worker in self.workers:
+            worker.start()
         self.server_thread.start()
 
     def die(self):
-        self.shutdown()
-        self.server_close()
+        self.running = False
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join(1.0)
+        self.waker.wake()
+        self.server_thread.join()
+        asyncore.close_all(map=self.socket_map)
+
+    def _serve(self):
+        while self.running:
+            asyncore.loop(timeout=1.0, map=self.socket_map, count=1)
+
+    def _work(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+
+            connection, cmd = request
+            try:
+                response = handle_request(self.radar, cmd)
+            except Exception:
+                self.logger.exception("Request {}".format(cmd))
+                response = None
+
+            connection.reply(response)
+            self.waker.wake()
+
+    def _on_wake(self):
+        self._publish()
+
+        for publisher in (self.frames, self.sbs):
+            items = [item for batch in publisher.take() for item in batch]
+            if items:
+                for port in self.ports:
+                    if port.publisher is publisher:
+                        port.distribute(items)
+
+    def update_active(self):
+        for publisher in (self.frames, self.sbs):
+            publisher.active = any(port.clients for port in self.ports if port.publisher is publisher)
+
+    def _publish(self):
+        messages = self.publisher.take()
+        if not messages or not self.subscribers:
+            return
+
+        # Every message is encoded once for all subscribers, as a frame or a line
+        frames = [FRAME_HEADER.pack(len(message)) + message for message in messages]
+        lines = [message + '\n' for message in messages]
+        limit = basic.ADSB.cfg_subscriber_buffer
+
+        for connection in list(self.subscribers):
+            encoded = lines if connection.legacy else frames
+            room = limit - len(connection.out)
+            if room < len(encoded):
+                if basic.ADSB.cfg_subscriber_overflow == "disconnect":
+                    self.logger.info("Subscriber {} too slow, disconnected".format(connection.addr))
+                    basic.statistics['subscriber_disconnects'] += 1
+                    connection.close()
+                    continue
+                basic.statistics['subscriber_dropped'] += len(encoded) - max(room, 0)
+                encoded = encoded[:max(room, 0)]
+            with connection.out_lock:
+                connection.out.extend(encoded)
+            basic.statistics['subscriber_messages'] += len(encoded)
+
+    def subscribe(self, connection):
+        connection.subscribed = True
+        connection.in_buffer = ''
+        self.subscribers.add(connection)
+        self.publisher.active = True
+        basic.statistics['subscribers'] = len(self.subscribers)
+
+    def unsubscribe(self, connection):
+        self.subscribers.discard(connection)
+        self.publisher.active = len(self.subscribers) > 0
+        basic.statistics['subscribers'] = len(self.subscribers)
+
+    def submit(self, connection, cmd):
+        if cmd.strip() == "SUBSCRIBE":
+            self.subscribe(connection)
+            return
+        connection.busy = True
+        basic.statistics['server_requests'] += 1
+        self.requests.put((connection, cmd))
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            Connection(pair[0], self)
+
+    def handle_error(self):
+        self.logger.exception("Server")
@@ -1,32 +1,80 @@
+import array
 import basic
+import bisect
 import math
 import logging
 import time
 
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Only needed by the *_array decoders, callsign_batch and decodeCPR_batch
+
 __author__ = 'Wolfrax'
 
 """
 Implements the Squitter class which represents decoded messages.
+
+Squitter objects keep the decoded values as numbers, formatting into strings is done when they are shown.
+
+The altitude, identity and movement decoders use lookup tables built on first use, the *_array variants decode numpy
+arrays of fields with the same tables. callsign uses integer shifts and a character table, callsign_batch decodes the
+call signs of many frames at once. CPR_NL looks up the longitude zones with bisect, decodeCPR_batch decodes the
+positions of many aircraft at once.
+
+Decoding dispatches on the downlink format and the type code through the DF_DECODERS and TC_DECODERS tables, decoders
+for other message types are added with register_df and register_tc. In lazy decode mode the decoders registered with
+register_lazy, of values only shown and not needed for tracking, are deferred until the values are read.
 """
 
 
-def callsign(cs):
-    char_set = '#ABCDEFGHIJKLMNOPQRSTUVWXYZ#####_###############0123456789######'
+CALLSIGN_CHARS = '#ABCDEFGHIJKLMNOPQRSTUVWXYZ#####_###############0123456789######'
+_CALLSIGN_TABLE = tuple('' if char in '#_' else char for char in CALLSIGN_CHARS)  # Padding and invalid are dropped
+_CALLSIGN_CACHE_SIZE = 10000
+_callsign_cache = {}  # {icao: (characters, call sign)}
 
-    csbin = bin(int(cs, 16))[2:].zfill(len(cs) * 4)[40:88]
-    sign = ""
-    sign += char_set[int(csbin[00:06], 2)]
-    sign += char_set[int(csbin[06:12], 2)]
-    sign += char_set[int(csbin[12:18], 2)]
-    sign += char_set[int(csbin[18:24], 2)]
-    sign += char_set[int(csbin[24:30], 2)]
-    sign += char_set[int(csbin[30:36], 2)]
-    sign += char_set[int(csbin[36:42], 2)]
-    sign += char_set[int(csbin[42:48], 2)]
-    return sign.translate(None, ''.join(['_', '#']))
 
+def callsign(msg, icao=None):
+    """
+    The call sign in a 112 bit message (identification and BDS 2,0 replies), 8 characters of 6 bits from bit 40.
+    With icao the call sign is cached and only decoded when the characters sent by the aircraft change.
+    """
+    chars = (msg >> 24) & 0xFFFFFFFFFFFF
+    if icao is not None:
+        cached = _callsign_cache.get(icao)
+        if cached is not None and cached[0] == chars:
+            return cached[1]
 
-def parse_id13(field):
+    table = _CALLSIGN_TABLE
+    sign = table[chars >> 42] + table[(chars >> 36) & 0x3F] + table[(chars >> 30) & 0x3F] + \
+        table[(chars >> 24) & 0x3F] + table[(chars >> 18) & 0x3F] + table[(chars >> 12) & 0x3F] + \
+        table[(chars >> 6) & 0x3F] + table[chars & 0x3F]
+
+    if icao is not None:
+        if len(_callsign_cache) >= _CALLSIGN_CACHE_SIZE:
+            _callsign_cache.clear()
+        _callsign_cache[icao] = (chars, sign)
+    return sign
+
+
+def callsign_batch(frames):
+    """
+    The call signs of many messages, frames is a (N, 14) numpy uint8 array as in basic.FrameBatch.
+    Returns a list of strings, the frames must be identification or BDS 2,0 messages (not checked)
+    """
+    data = frames[:, 5:11].astype(np.uint8)  # Bytes 5 to 10 are bit 40 to 87
+    codes = np.empty((len(frames), 8), dtype=np.uint8)
+    for ind in range(2):  # 3 bytes give 4 characters
+        b0, b1, b2 = data[:, 3 * ind], data[:, 3 * ind + 1], data[:, 3 * ind + 2]
+        codes[:, 4 * ind] = b0 >> 2
+        codes[:, 4 * ind + 1] = ((b0 & 0x03) << 4) | (b1 >> 4)
+        codes[:, 4 * ind + 2] = ((b1 & 0x0F) << 2) | (b2 >> 6)
+        codes[:, 4 * ind + 3] = b2 & 0x3F
+    signs = np.frombuffer(CALLSIGN_CHARS, dtype='S1')[codes]  # (N, 8) characters, viewed as one string per row
+    return [sign.translate(None, '#_') for sign in signs.view('S8').ravel().tolist()]
+
+
+def _parse_id13(field):
     hex_gillham = 0
 
     if field & 0x1000:
@@ -57,7 +105,7 @@ def parse_id13(field):
     return hex_gillham
 
 
-def ModeA_2_ModeC(ModeA):
+def _ModeA_2_ModeC(ModeA):
     # Input format is: 00:A4:A2:A1:00:B4:B2:B1:00:C4:C2:C1:00:D4:D2:D1
     five_hundreds = one_hundreds = 0
 
@@ -107,7 +155,7 @@ def ModeA_2_ModeC(ModeA):
     return (five_hundreds * 5) + one_hundreds - 13
 
 
-def parse_ac13(field):
+def _parse_ac13(field):
     """
     Parse the 13 bit AC altitude field
     :param field: to be decoded
@@ -124,7 +172,7 @@ def parse_ac13(field):
             return (n * 25) - 1000
         else:
             # n is an 11 bit Gillham coded altitude
-            n = ModeA_2_ModeC(parse_id13(field))
+            n = _ModeA_2_ModeC(_parse_id13(field))
             n = 0 if n < -12 else 100 * n
             return n
     else:  # meter
@@ -132,7 +180,7 @@ def parse_ac13(field):
         # TODO: Implement altitude when meter unit is selected
 
 
-def parse_ac12(field):
+def _parse_ac12(field):
     q_bit = field & 0x10  # Bit 48 = Q
 
     if q_bit != 0:
@@ -143,11 +191,11 @@ def parse_ac12(field):
     else:
         # Make N a 13 bit Gillham coded altitude by inserting M=0 at bit 6
         n = ((field & 0x0FC0) << 1) | (field & 0x003F)
-        n = ModeA_2_ModeC(parse_id13(n))
+        n = _ModeA_2_ModeC(_parse_id13(n))
         return 0 if n < -12 else 100 * n
 
 
-def parse_movement(movement):
+def _parse_movement(movement):
     # Note : movement codes 0,125,126,127 are all invalid, but they are
     #        trapped for before this function is called.
 
@@ -169,35 +217,220 @@ def parse_movement(movement):
     return gspeed
 
 
+# The decoders below are pure functions of 7 to 16 bit fields. They are used through lookup tables, built on first
+# use by calling the decoder for every value of the field. The tables are array.array of C ints
+
+
+class _LookupTables(dict):
+    """
+    The lookup tables by name (see _TABLES), a table is built when it is looked up the first time
+    """
+
+    def __missing__(self, name):
+        func, size = _TABLES[name]
+        table = self[name] = array.array('i', [func(ind) for ind in xrange(size)])
+        return table
+
+
+class _NumpyTables(dict):
+    """
+    The lookup tables as numpy arrays sharing memory with the array.array, for the vectorised decoders
+    """
+
+    def __missing__(self, name):
+        table = self[name] = np.frombuffer(_tables[name], dtype=np.intc)
+        return table
+
+
+def parse_id13(field):
+    return _tables['id13'][field]
+
+
+def ModeA_2_ModeC(ModeA):
+    if (ModeA & 0xFFFF888B) or ((ModeA & 0x000000F0) == 0):
+        return -9999
+    return _tables['mode_c'][ModeA >> 2]  # The two lowest bits (D1, D2) are 0 here
+
+
+def parse_ac13(field):
+    """
+    Parse the 13 bit AC altitude field
+    :param field: to be decoded
+    :return: altitude in feet
+    """
+    return _tables['ac13'][field]
+
+
+def parse_ac12(field):
+    return _tables['ac12'][field]
+
+
+def parse_movement(movement):
+    return _tables['movement'][movement]
+
+
+def parse_id13_array(fields):
+    """
+    parse_id13 of a numpy array of fields, as are the other *_array functions below
+    """
+    return _np_tables['id13'][fields]
+
+
+def ModeA_2_ModeC_array(ModeA):
+    valid = ((ModeA & 0xFFFF888B) == 0) & ((ModeA & 0x000000F0) != 0)
+    return np.where(valid, _np_tables['mode_c'][np.where(valid, ModeA >> 2, 0)], -9999)
+
+
+def parse_ac13_array(fields):
+    return _np_tables['ac13'][fields]
+
+
+def parse_ac12_array(fields):
+    return _np_tables['ac12'][fields]
+
+
+def parse_movement_array(movements):
+    return _np_tables['movement'][movements]
+
+
+_TABLES = {'id13': (_parse_id13, 1 << 13),
+           'mode_c': (lambda ind: _ModeA_2_ModeC(ind << 2), (0x7774 >> 2) + 1),  # Highest valid Mode A code is 0x7774
+           'ac13': (_parse_ac13, 1 << 13),
+           'ac12': (_parse_ac12, 1 << 12),
+           'movement': (_parse_movement, 1 << 7)}
+_tables = _LookupTables()
+_np_tables = _NumpyTables()
+
+
+# The NL latitude limits in ascending order for bisect, and the NL for a latitude below the lowest (0) limit
+_NL_ASCENDING = tuple(reversed(basic.ADSB.NL))
+_NL_MAX = len(basic.ADSB.NL) + 1
+
+
 def CPR_NL(lat):
     """
-    Return index from pre-computed table
-    :param lat: 
-    :return: 
+    The number of longitude zones at latitude, from the pre-computed table of latitude limits
     """
     lat = abs(lat)
-    if lat >= max(basic.ADSB.NL):
+    if lat >= _NL_ASCENDING[-1]:
         return 1
-    elif lat <= min(basic.ADSB.NL):
-        return len(basic.ADSB.NL) + 1
-    else:
-        return basic.ADSB.NL.index(max(filter(lambda x: x < lat, basic.ADSB.NL))) + 1
+    return _NL_MAX - bisect.bisect_left(_NL_ASCENDING, lat)
+
+
+def CPR_NL_array(lat):
+    """
+    CPR_NL of a numpy array of latitudes
+    """
+    lat = np.abs(lat)
+    return np.where(lat >= _NL_ASCENDING[-1], 1, _NL_MAX - np.searchsorted(_NL_ASCENDING, lat, side='left'))
+
+
+def decodeCPR_batch(even_lat, even_lon, odd_lat, odd_lon, even_time, odd_time):
+    """
+    Global CPR decoding of many even/odd pairs at once, as Squitter.decodeCPR does for one aircraft.
+
+    The arguments are arrays (or sequences) of the raw 17 bits even and odd latitude/longitude and the times they were
+    received, 0 when not received. Returns the arrays latitude, longitude and valid, valid is False for the pairs that
+    could not be decoded (a message missing, more than 10 seconds apart or in different latitude zones), their
+    latitude and longitude are nan. The statistics are not updated.
+    """
+    even_time = np.asarray(even_time, dtype=np.float64)
+    odd_time = np.asarray(odd_time, dtype=np.float64)
+    cpr_lat_even = np.asarray(even_lat, dtype=np.float64) / basic.ADSB.MAX_17_BITS
+    cpr_lon_even = np.asarray(even_lon, dtype=np.float64) / basic.ADSB.MAX_17_BITS
+    cpr_lat_odd = np.asarray(odd_lat, dtype=np.float64) / basic.ADSB.MAX_17_BITS
+    cpr_lon_odd = np.asarray(odd_lon, dtype=np.float64) / basic.ADSB.MAX_17_BITS
+
+    j = np.floor(59 * cpr_lat_even - 60 * cpr_lat_odd + 0.5)  # latitude index
+
+    latitude_even = (360.0 / 60.0) * (j % 60 + cpr_lat_even)
+    latitude_odd = (360.0 / 59.0) * (j % 59 + cpr_lat_odd)
+    latitude_even[latitude_even >= 270] -= 360
+    latitude_odd[latitude_odd >= 270] -= 360
+
+    nl_even = CPR_NL_array(latitude_even)
+    nl_odd = CPR_NL_array(latitude_odd)
+
+    even_latest = even_time >= odd_time
+    latitude = np.where(even_latest, latitude_even, latitude_odd)
+    nl = np.where(even_latest, nl_even, nl_odd)
+    ni = np.maximum(np.where(even_latest, nl, nl - 1), 1)
+    m = np.floor(cpr_lon_even * (nl - 1) - cpr_lon_odd * nl + 0.5)
+    longitude = (360.0 / ni) * (m % ni + np.where(even_latest, cpr_lon_even, cpr_lon_odd))
+    longitude[longitude >= 180] -= 360
+
+    valid = (even_time != 0) & (odd_time != 0) & (np.abs(odd_time - even_time) <= 10.0) & (nl_even == nl_odd)
+    latitude[~valid] = np.nan
+    longitude[~valid] = np.nan
+    return latitude, longitude, valid
+
+
+def CPR_local(lat_cpr, lon_cpr, odd, surface, ref_latitude, ref_longitude):
+    """
+    Decode a position from one message, given the cpr latitude and longitude (raw / 2^17), using a reference position
+    closer than half a zone: 3 degrees latitude for airborne and 0.75 degrees for surface positions.
+    Returns (latitude, longitude)
+    """
+    zone = 90.0 if surface else 360.0
+    d_lat = zone / (59.0 if odd else 60.0)
+    j = int(math.floor(ref_latitude / d_lat)) + int(math.floor((ref_latitude % d_lat) / d_lat - lat_cpr + 0.5))
+    latitude = d_lat * (j + lat_cpr)
+
+    d_lon = zone / max(CPR_NL(latitude) - (1 if odd else 0), 1)
+    m = int(math.floor(ref_longitude / d_lon)) + int(math.floor((ref_longitude % d_lon) / d_lon - lon_cpr + 0.5))
+    longitude = d_lon * (m + lon_cpr)
+
+    return latitude, longitude
+
+
+def distance_km(latitude_1, longitude_1, latitude_2, longitude_2):
+    """
+    Approximate distance between two positions, good enough for the range of a receiver
+    """
+    x = math.radians(longitude_2 - longitude_1) * math.cos(math.radians((latitude_1 + latitude_2) / 2.0))
+    y = math.radians(latitude_2 - latitude_1)
+    return basic.ADSB.EARTH_RADIUS_KM * math.hypot(x, y)
 
 
 class Squitter(basic.ADSB):
+    """
+    A decoded message.
+
+    A Squitter is created for every message from the tuner, so the attributes are slots and the decoded values are
+    kept as numbers in the units of the message (feet, knots, degrees, ft/min), None means not present in the message.
+    The values are formatted into strings only when shown: by __str__ and by msg['key'] which gives the strings for
+    the keys in KEYS, "" when not present. TextDisplay and the server serializer (formatted) use the latter.
+    """
+
+    __slots__ = ('signal_strength', 'downlink_format', 'icao', 'squawk', 'altitude', 'call_sign', 'velocity',
+                 'heading', 'latitude', 'longitude',
+                 'msg', 'no_of_bits', 'capability', 'type_code', 'emitter_category', 'parity', 'crc_sum', 'crc_ok',
+                 'vertical_rate', 'ew_velocity', 'ns_velocity', 'flight_status',
+                 'odd_raw_latitude', 'odd_raw_longitude', 'even_raw_latitude', 'even_raw_longitude',
+                 'even_time', 'odd_time', 'on_ground', 'selected_altitude', 'adsb_version', 'deferred',
+                 'pending', 'timestamp')
+
+    KEYS = ('signal_strength', 'downlink_format', 'ICAO24', 'squawk', 'altitude', 'call_sign', 'velocity', 'heading',
+            'latitude', 'longitude')
+    _ATTRS = dict(zip(KEYS, ('signal_strength', 'downlink_format', 'icao', 'squawk', 'altitude', 'call_sign',
+                             'velocity', 'heading', 'latitude', 'longitude')))
+
+    logger = logging.getLogger('spots.squitter')
+
+    MAX_PENDING = 64  # Messages with deferred decoders kept by update before they are decoded
+
     def __init__(self):
-        basic.ADSB.__init__(self)
-
-        self.data = {'signal_strength': "",
-                     'downlink_format': "",
-                     'ICAO24': "",
-                     'squawk': "",
-                     'altitude': "",
-                     'call_sign': "",
-                     'velocity': "",
-                     'heading': "",
-                     'latitude': "",
-                     'longitude': ""}
+        # The values shown, None when not present
+        self.signal_strength = None  # %
+        self.downlink_format = None
+        self.icao = None
+        self.squawk = None  # The identity, shown as hex
+        self.altitude = None  # feet
+        self.call_sign = None
+        self.velocity = None  # knots
+        self.heading = None  # degrees
+        self.latitude = None
+        self.longitude = None
 
         # This is the Squitter object definition and initialization
         self.msg = 0
@@ -206,12 +439,12 @@ class Squitter(basic.ADSB):
         self.type_code = 0
         self.emitter_category = 0
         self.parity = 0
-        self.crc_sum = "0"
+        self.crc_sum = 0
         self.crc_ok = False
-        self.vertical_rate = 0
+        self.vertical_rate = None  # ft/min
         self.ew_velocity = 0
         self.ns_velocity = 0
-        self.flight_status = 0
+        self.flight_status = None
         self.odd_raw_latitude = 0
         self.odd_raw_longitude = 0
         self.even_raw_latitude = 0
@@ -219,62 +452,129 @@ class Squitter(basic.ADSB):
         self.even_time = 0
         self.odd_time = 0
         self.on_ground = False
-
-        self.logger = logging.getLogger('spots.squitter')
+        self.selected_altitude = None  # feet, from target state and status messages
+        self.adsb_version = None
+        # Lazy decode mode, see resolve: the decoders deferred for this message and the newer messages merged by update
+        self.deferred = None
+        self.pending = None
+        self.timestamp = None  # Of the frame in ticks of a 12 MHz clock, when the tuner has set it
 
     def __setitem__(self, key, value):
-        self.data[key] = value
+        """
+        Set the value of key (one of KEYS) in the units of the attribute, "" is the same as None (not present).
+        ICAO24 can also be set from a hex string.
+        """
+        if key not in self._ATTRS:
+            raise KeyError(key)
+        if value == "":
+            value = None
+        elif key == 'ICAO24' and isinstance(value, basestring):
+            value = int(value, 16)
+        setattr(self, self._ATTRS[key], value)
 
     def __getitem__(self, item):
-        return self.data[item]
+        """
+        The value of item (one of KEYS) formatted as a string, "" when not present
+        """
+        if self.deferred is not None or self.pending is not None:
+            self.resolve()
+        if item not in self._ATTRS:
+            raise KeyError(item)
+        value = getattr(self, self._ATTRS[item])
+        if value is None:
+            return ""
+        if item == 'ICAO24':
+            return "{:x}".format(value)
+        if item == 'altitude':
+            return str(int(round(self.METER_PER_FOOT * value))) if self.cfg_use_metric else str(value)
+        if item == 'velocity':
+            return str(int(round(self.KPH_PER_KNOT * value))) if self.cfg_use_metric else str(int(round(value)))
+        if item == 'heading':
+            return str(int(round(value)))
+        if item == 'latitude' or item == 'longitude':
+            return str(round(value, 3))
+        if item == 'squawk':
+            return "{:=04X}".format(value)
+        return str(value)
 
     def __iter__(self):
-        for key in self.data:
+        for key in self.KEYS:
             yield key
 
+    def formatted(self):
+        """
+        All values as a dictionary of strings, as sent by the server
+        """
+        self.resolve()
+        return {key: self[key] for key in self.KEYS}
+
     def __str__(self):
+        self.resolve()
         st = ""
         st += "* {}\n".format(hex(self.msg)[2:-1])
         st += "{} ".format(hex(self.parity)[2:-1])
-        st += "CRC: {} ({}) ".format(self.crc_sum, "ok" if self.crc_ok else "not ok")
+        st += "CRC: {:x} ({}) ".format(self.crc_sum, "ok" if self.crc_ok else "not ok")
         st += "ICAO: {} ".format(self['ICAO24'])
-        st += "DF - {} ".format(self.squitter['downlink_format'][int(self['downlink_format'])])
+        st += "DF - {} ".format(self.squitter['downlink_format'][self.downlink_format])
         st += "TC - {} ".format(self.squitter['type_code'][self.type_code])
 
-        if self['altitude'] != "":
+        if self.altitude is not None:
             st += "{}{} ".format(self['altitude'], "m" if self.cfg_use_metric else "ft")
-        if self['call_sign'] != "":
-            st += "{} ".format(self['call_sign'])
-        if self['squawk'] != "":
+        if self.call_sign is not None:
+            st += "{} ".format(self.call_sign)
+        if self.squawk is not None:
             st += "squawk: {} ".format(self['squawk'])
-        if self['longitude'] != "":
+        if self.longitude is not None:
             st += "long: {} ".format(self['longitude'])
-        if self['latitude'] != "":
+        if self.latitude is not None:
             st += "lat: {} ".format(self['latitude'])
-        if self.vertical_rate != 0:
-            st += "vrate: {} ".format(self.vertical_rate)
-        if self['velocity'] != "":
+        if self.vertical_rate is not None:
+            st += "vrate: {} ".format(int(round(self.METER_PER_FOOT * self.vertical_rate)) if self.cfg_use_metric
+                                      else self.vertical_rate)
+        if self.velocity is not None:
             st += "vel: {} ".format(self['velocity'])
-        if self['heading'] != "":
+        if self.heading is not None:
             st += "head: {} ".format(self['heading'])
-        if self.flight_status != 0:
+        if self.flight_status is not None:
             st += "fs: {} {} ".format(self.flight_status, self.squitter["flight_status"][self.flight_status])
-        if self['signal_strength'] != "":
+        if self.selected_altitude is not None:
+            st += "sel alt: {}{} ".format(int(round(self.METER_PER_FOOT * self.selected_altitude))
+                                          if self.cfg_use_metric else self.selected_altitude,
+                                          "m" if self.cfg_use_metric else "ft")
+        if self.adsb_version is not None:
+            st += "ver: {} ".format(self.adsb_version)
+        if self.signal_strength is not None:
             st += "sig: {}% ".format(self['signal_strength'])
 
         return st
 
     def update(self, msg):
-        self.data['signal_strength'] = msg['signal_strength']
-        self.data['downlink_format'] = msg['downlink_format']
-
-        self.data['squawk'] = msg['squawk'] if msg['squawk'] != "" else self.data['squawk']
-        self.data['altitude'] = msg['altitude'] if msg['altitude'] != "" else self.data['altitude']
-        self.data['call_sign'] = msg['call_sign'] if msg['call_sign'] != "" else self.data['call_sign']
-        self.data['velocity'] = msg['velocity'] if msg['velocity'] != "" else self.data['velocity']
-        self.data['heading'] = msg['heading'] if msg['heading'] != "" else self.data['heading']
-        self.data['latitude'] = msg['latitude'] if msg['latitude'] != "" else self.data['latitude']
-        self.data['longitude'] = msg['longitude'] if msg['longitude'] != "" else self.data['longitude']
+        """
+        Merge the newer message msg of the same aircraft into this one. In lazy decode mode the messages with deferred
+        decoders are kept until the values are read, see resolve.
+        """
+        self.signal_strength = msg.signal_strength
+        self.downlink_format = msg.downlink_format
+
+        self.squawk = msg.squawk if msg.squawk is not None else self.squawk
+        self.altitude = msg.altitude if msg.altitude is not None else self.altitude
+        self.call_sign = msg.call_sign if msg.call_sign is not None else self.call_sign
+        self.velocity = msg.velocity if msg.velocity is not None else self.velocity
+        self.heading = msg.heading if msg.heading is not None else self.heading
+        self.latitude = msg.latitude if msg.latitude is not None else self.latitude
+        self.longitude = msg.longitude if msg.longitude is not None else self.longitude
+        self.selected_altitude = msg.selected_altitude if msg.selected_altitude is not None else self.selected_altitude
+        self.adsb_version = msg.adsb_version if msg.adsb_version is not None else self.adsb_version
+        self.vertical_rate = msg.vertical_rate if msg.vertical_rate is not None else self.vertical_rate
+        self.flight_status = msg.flight_status if msg.flight_status is not None else self.flight_status
+
+        if msg.odd_time != 0.0 or msg.even_time != 0.0:
+            if msg.on_ground != self.on_ground:
+                # A surface and an airborne message do not make an even/odd pair
+                self.odd_time = self.even_time = 0
+                self.odd_raw_latitude = self.odd_raw_longitude = 0
+                self.even_raw_latitude = self.even_raw_longitude = 0
+            self.on_ground = msg.on_ground
 
         self.odd_raw_latitude = msg.odd_raw_latitude if msg.odd_raw_latitude != 0 else self.odd_raw_latitude
         self.odd_raw_longitude = msg.odd_raw_longitude if msg.odd_raw_longitude != 0 else self.odd_raw_longitude
@@ -284,12 +584,79 @@ class Squitter(basic.ADSB):
         self.even_time = msg.even_time if msg.even_time != 0.0 else self.even_time
         self.odd_time = msg.odd_time if msg.odd_time != 0.0 else self.odd_time
 
+        if msg.deferred is not None and msg is not self:
+            if self.pending is None:
+                self.pending = [msg]
+            else:
+                self.pending.append(msg)
+                if len(self.pending) > self.MAX_PENDING:
+                    self.resolve()  # Nobody reads the values, keep the memory bounded
+
+    def resolve(self):
+        """
+        Decode the values deferred in lazy decode mode, the same values as decoding every message would give.
+
+        The messages merged by update are decoded newest first. A value is found when a decoder run on a newer message
+        has set it (not None, 0 is a value), as update does in eager mode, and a deferred decoder is only run when a
+        value it sets has not been found. So values overwritten by newer messages are usually not decoded. The values
+        are kept until update merges newer messages.
+        """
+        if self.pending is None:
+            if self.deferred is not None:
+                for decoder in self.deferred:
+                    decoder(self)
+                self.deferred = None
+            return
+
+        messages = self.pending
+        if self.deferred is not None:
+            # Decode the oldest message, this one, on a copy so that it does not overwrite newer values
+            first = Squitter()
+            first.msg, first.no_of_bits, first.type_code = self.msg, self.no_of_bits, self.type_code
+            first.deferred = self.deferred
+            messages.insert(0, first)
+        self.pending = self.deferred = None
+
+        found = set()
+        for msg in reversed(messages):
+            for decoder in msg.deferred:
+                names = LAZY_DECODERS[decoder]
+                if found.issuperset(names):
+                    continue
+                decoder(msg)
+                for name in names:
+                    if name not in found:
+                        value = getattr(msg, name)
+                        if value is not None:
+                            setattr(self, name, value)
+                            found.add(name)
+            msg.deferred = None
+
     def get_downlink_format(self):
-        return self['downlink_format']
+        return self.downlink_format
 
     def _get_msg_byte(self, byte_nr):
         return (self.msg >> (self.no_of_bits - (byte_nr + 1) * 8)) & 0xFF
 
+    def _latest_cpr(self):
+        """
+        (odd, cpr latitude, cpr longitude) of the latest message with a position, None if there is none
+        """
+        if self.odd_time == 0 and self.even_time == 0:
+            return None
+        if self.even_time >= self.odd_time:
+            return False, self.even_raw_latitude / self.MAX_17_BITS, self.even_raw_longitude / self.MAX_17_BITS
+        return True, self.odd_raw_latitude / self.MAX_17_BITS, self.odd_raw_longitude / self.MAX_17_BITS
+
+    def _set_position(self, latitude, longitude):
+        self.latitude = latitude if latitude != 0.0 else None
+        self.longitude = longitude if longitude != 0.0 else None
+
+        basic.statistics['max_lat'] = max(basic.statistics['max_lat'], latitude)
+        basic.statistics['min_lat'] = min(basic.statistics['min_lat'], latitude)
+        basic.statistics['max_lon'] = max(basic.statistics['max_lon'], longitude)
+        basic.statistics['min_lon'] = min(basic.statistics['min_lon'], longitude)
+
     def decodeCPR_relative(self):
         # Basic algorithm
         #   https://adsb-decode-guide.readthedocs.io/en/latest/content/airborne-position.html
@@ -304,50 +671,38 @@ class Squitter(basic.ADSB):
         # After the first initial successful call to decodeCPR, the radar routine will for succeeding message call
         # decodeCPR first. If this call returns False, it will call decodeCPR_relative.
         #
-        # decodeCPR_relative will decode if it has at least one even or odd message available, it will decode using
-        # the latest latitude/longitude. It will not use the static coordinates in the configuration file for the ADS-B
-        # reciever as previously tried.
+        # decodeCPR_relative will decode the latest even or odd message, using the latest latitude/longitude as
+        # reference. Decoding against the receiver position in the configuration file is done by decodeCPR_local.
 
-        if self.odd_time == 0 and self.even_time == 0:
+        cpr = self._latest_cpr()
+        if cpr is None:
             return False  # Got to have at least one message
-        if self.data['latitude'] == "" or self.data['longitude'] == "":
+        if self.latitude is None or self.longitude is None:
             return False  # decodeCPR has not yet decoded a position, needed before we try to decode relative
 
-        if self.odd_time == 0:  # Even message
-            d_lat = 360.0 / 60.0
-            lat_cpr = self.even_raw_latitude / self.MAX_17_BITS
-            lon_cpr = self.even_raw_longitude / self.MAX_17_BITS
-        else:                   # Odd message
-            d_lat = 360.0 / 59.0
-            lat_cpr = self.odd_raw_latitude / self.MAX_17_BITS
-            lon_cpr = self.odd_raw_longitude / self.MAX_17_BITS
-
-        lat = float(self.data['latitude'])
-        j = int(math.floor(lat / d_lat)) + int(math.floor((lat % d_lat) / d_lat - lat_cpr + 0.5))  # latitude index
-        # j = int(math.floor(self.cfg_latitude / d_lat)) + \
-        #    int(math.floor((self.cfg_latitude % d_lat) / d_lat - lat_cpr + 0.5))  # latitude index
-
-        latitude = d_lat * (j + lat_cpr)
-
-        if CPR_NL(latitude) == 0:
-            d_lon = 360.0
-        else:
-            d_lon = 360.0 / CPR_NL(latitude)
+        odd, lat_cpr, lon_cpr = cpr
+        latitude, longitude = CPR_local(lat_cpr, lon_cpr, odd, self.on_ground, self.latitude, self.longitude)
+        self._set_position(latitude, longitude)
 
-        lon = float(self.data['longitude'])
-        m = int(math.floor(lon / d_lon)) + int(math.floor((lon % d_lon) / d_lon - lon_cpr + 0.5))
-        # m = int(math.floor(self.cfg_longitude / d_lon)) + \
-        #    int(math.floor((self.cfg_longitude % d_lon) / d_lon - lon_cpr + 0.5))
+        return True
 
-        longitude = d_lon * (m + lon_cpr)
+    def decodeCPR_local(self):
+        """
+        Decode the latest even or odd message using the receiver position (user latitude/longitude) as reference.
+        Gives a position from a single message, also for surface messages which can not be decoded globally. The
+        position is only accepted within cfg_local_cpr_max_range km of the receiver, cfg_local_cpr_surface_max_range km
+        for surface positions (the zones are a quarter of the airborne zones).
+        """
+        cpr = self._latest_cpr()
+        if cpr is None:
+            return False
 
-        self.data['latitude'] = str(round(latitude, 3)) if latitude != 0.0 else ""
-        self.data['longitude'] = str(round(longitude, 3)) if longitude != 0.0 else ""
-
-        basic.statistics['max_lat'] = max(basic.statistics['max_lat'], latitude)
-        basic.statistics['min_lat'] = min(basic.statistics['min_lat'], latitude)
-        basic.statistics['max_lon'] = max(basic.statistics['max_lon'], longitude)
-        basic.statistics['min_lon'] = min(basic.statistics['min_lon'], longitude)
+        odd, lat_cpr, lon_cpr = cpr
+        latitude, longitude = CPR_local(lat_cpr, lon_cpr, odd, self.on_ground, self.cfg_latitude, self.cfg_longitude)
+        max_range = self.cfg_local_cpr_surface_max_range if self.on_ground else self.cfg_local_cpr_max_range
+        if distance_km(self.cfg_latitude, self.cfg_longitude, latitude, longitude) > max_range:
+            return False  # Too far away to be unambiguous, or a bad message
+        self._set_position(latitude, longitude)
 
         return True
 
@@ -358,6 +713,8 @@ class Squitter(basic.ADSB):
 
         if self.odd_time == 0 or self.even_time == 0:
             return False  # we need both even + odd messages
+        if self.on_ground:
+            return False  # Surface positions need a reference, see decodeCPR_local
         if abs(self.odd_time - self.even_time) > 10.0:
             # Reference for 10 seconds, chapter 2.4:
             # http://www.eurocontrol.int/eec/gallery/content/public/document/eec/report/1995/002_Aircraft_Position_Report_using_DGPS_Mode-S.pdf
@@ -379,33 +736,25 @@ class Squitter(basic.ADSB):
         if latitude_odd >= 270:
             latitude_odd -= 360
 
-        if CPR_NL(latitude_even) != CPR_NL(latitude_odd):
+        nl = CPR_NL(latitude_even)
+        if nl != CPR_NL(latitude_odd):
             return False  # Different latitude zones, not possible to compute position now
 
-        # We have Ok conditions, set the latitude and continue with longitude calculation
+        # We have Ok conditions, set the latitude and continue with longitude calculation, both are in the same zone
         latitude = latitude_even if self.even_time >= self.odd_time else latitude_odd
 
+        m = int(math.floor(cpr_lon_even * (nl - 1) - cpr_lon_odd * nl + 0.5))
         if self.even_time >= self.odd_time:
-            ni = max(CPR_NL(latitude_even), 1)
-            dlon = 360.0 / ni
-            m = int(math.floor(cpr_lon_even * (CPR_NL(latitude_even) - 1) - cpr_lon_odd * CPR_NL(latitude_even) + 0.5))
-            longitude = dlon * (m % ni + cpr_lon_even)
+            ni = max(nl, 1)
+            longitude = (360.0 / ni) * (m % ni + cpr_lon_even)
         else:
-            ni = max(CPR_NL(latitude_odd) - 1, 1)
-            dlon = 360.0 / ni
-            m = int(math.floor(cpr_lon_even * (CPR_NL(latitude_odd) - 1) - cpr_lon_odd * CPR_NL(latitude_odd) + 0.5))
-            longitude = dlon * (m % ni + cpr_lon_odd)
+            ni = max(nl - 1, 1)
+            longitude = (360.0 / ni) * (m % ni + cpr_lon_odd)
 
         if longitude >= 180:
             longitude -= 360
 
-        self.data['latitude'] = str(round(latitude, 3)) if latitude != 0.0 else ""
-        self.data['longitude'] = str(round(longitude, 3)) if longitude != 0.0 else ""
-
-        basic.statistics['max_lat'] = max(basic.statistics['max_lat'], latitude)
-        basic.statistics['min_lat'] = min(basic.statistics['min_lat'], latitude)
-        basic.statistics['max_lon'] = max(basic.statistics['max_lon'], longitude)
-        basic.statistics['min_lon'] = min(basic.statistics['min_lon'], longitude)
+        self._set_position(latitude, longitude)
 
         # Reset all flags
         self.odd_time = 0
@@ -423,15 +772,18 @@ class Squitter(basic.ADSB):
         Parse the message into the object
         """
 
-        # The object consists of 2 parts: [signal_strength, msg]
-        self['signal_strength'] = str(obj[0])
+        # The object consists of 2 parts: [signal_strength, msg], optionally followed by the crc syndrome of msg
+        # (when the tuner has computed it already, else None, see basic.FrameBatch) and the timestamp
+        self.signal_strength = obj[0]
         msg = obj[1]
+        if len(obj) > 3:
+            self.timestamp = obj[3]
 
         # Top 5 bits is DF
-        self['downlink_format'] = str((int(hex(msg)[2:4], base=16) & 0xF8) >> 3)
+        self.downlink_format = msg >> (self.MODES_LONG_MSG_BITS - 5)
 
         # Most significant bit indicates length
-        if int(self['downlink_format']) & 0x10:
+        if self.downlink_format & 0x10:
             self.msg = msg
             self.no_of_bits = self.MODES_LONG_MSG_BITS
         else:
@@ -442,26 +794,31 @@ class Squitter(basic.ADSB):
             return
 
         if self.cfg_check_crc:
-            self.crc_sum = self.crc(hex(self.msg))  # crc_sum is computed on a hexidecimal string
-            self.crc_ok = basic.ADSB.crc_2_int(self.crc_sum) == 0
+            self.crc_sum = obj[2] if len(obj) > 2 and obj[2] is not None else self.crc(self.msg, self.no_of_bits)
+            self.crc_ok = self.crc_sum == 0
             if self.crc_ok:
                 basic.statistics['valid_crc'] += 1
             else:
                 basic.statistics['not_valid_crc'] += 1
         else:
             # Skip crc check, discouraged
-            self.crc_sum = "0"
+            self.crc_sum = 0
             self.crc_ok = True
 
-        if not self.crc_ok and self.cfg_apply_bit_err_correction:  # Apply bit error correction
-            corrected_msg = self.correct_biterror(hex(self.msg), bits=1)
+        bits = self.cfg_bit_err_correction.get(self.downlink_format, 0)
+        if not self.crc_ok and self.cfg_apply_bit_err_correction and bits > 0:  # Apply bit error correction
+            corrected_msg = self.correct_biterror(self.msg, self.no_of_bits, bits=bits, syndrome=self.crc_sum)
             if corrected_msg is not None:
+                basic.statistics['corrected_{}_bit'.format(bin(corrected_msg ^ self.msg).count('1'))] += 1
                 self.crc_ok = True
+                self.crc_sum = 0
                 self.msg = corrected_msg
                 if self.crc_ok:
                     basic.statistics['valid_crc'] += 1
                 else:
                     basic.statistics['not_valid_crc'] += 1
+            else:
+                basic.statistics['not_corrected'] += 1
 
     def _get_vertical_rate(self):
         vertical_rate = ((self._get_msg_byte(8) & 0x07) << 6) | (self._get_msg_byte(9) >> 2)
@@ -469,24 +826,21 @@ class Squitter(basic.ADSB):
             vertical_rate -= 1
             if self._get_msg_byte(8) & 0x08:
                 vertical_rate = 0 - vertical_rate
-            vertical_rate = vertical_rate * 64
-            return int(round(self.METER_PER_FOOT * vertical_rate)) if self.cfg_use_metric else vertical_rate
+            return vertical_rate * 64
         else:
-            return 0
+            return None  # No information
 
     def _get_altitude(self):
         ac_12 = ((self._get_msg_byte(5) << 4) | (self._get_msg_byte(6) >> 4)) & 0x0FFF
         if ac_12 != 0:
-            altitude = parse_ac12(ac_12)
-            return int(round(self.METER_PER_FOOT * altitude)) if self.cfg_use_metric else altitude
+            return parse_ac12(ac_12)
         else:
             return 0
 
     def _get_velocity(self):
         movement = ((self._get_msg_byte(4) << 4) | (self._get_msg_byte(5) >> 4)) & 0x007F
         if 0 < movement < 125:
-            velocity = parse_movement(movement)
-            return int(round(self.KPH_PER_KNOT * velocity)) if self.cfg_use_metric else velocity
+            return parse_movement(movement)
         else:
             return 0
 
@@ -500,123 +854,157 @@ class Squitter(basic.ADSB):
         id_13 = ((self._get_msg_byte(2) << 8) | (self._get_msg_byte(3))) & 0x1FFF
         return parse_id13(id_13) if id_13 != 0 else 0
 
-    def decode_ADSB_msg(self):
-        if self.type_code == self.TC_TARGET_STATE_STATUS_29:
-            sub_type = (self._get_msg_byte(4) & 0x06) >> 1
+    def _get_me(self):
+        # The 56 bits message field of an extended squitter
+        return (self.msg >> 24) & 0xFFFFFFFFFFFFFF
+
+    def _run_decoders(self, decoders):
+        if self.cfg_lazy_decode:
+            split = _lazy_split.get(decoders)
+            if split is None:
+                split = _lazy_split[decoders] = (tuple(d for d in decoders if d not in LAZY_DECODERS),
+                                                 tuple(d for d in decoders if d in LAZY_DECODERS) or None)
+            eager, lazy = split
+            for decoder in eager:
+                decoder(self)
+            if lazy is not None:
+                self.deferred = lazy if self.deferred is None else self.deferred + lazy
         else:
-            sub_type = self._get_msg_byte(4) & 0x07
+            for decoder in decoders:
+                decoder(self)
 
-        if self.TC_ID_CAT_D_1 <= self.type_code <= self.TC_ID_CAT_A_4:
-            self['call_sign'] = callsign(hex(self.msg)[2:-1])
-            basic.statistics.add_flight(self['call_sign'])
-
-        if self.type_code == self.TC_AIRBORNE_VELOCITY_19:
-            if 1 <= sub_type <= 4:
-                self.vertical_rate = self._get_vertical_rate()
-            if 1 <= sub_type <= 2:
-                east_west_raw = ((self._get_msg_byte(5) & 0x03) << 8) | self._get_msg_byte(6)
-                north_south_raw = ((self._get_msg_byte(7) & 0x7F) << 3) | (self._get_msg_byte(8) >> 5)
-                ew_velocity = east_west_raw - 1
-                ns_velocity = north_south_raw - 1
-
-                if sub_type == 2:
-                    ew_velocity <<= 2
-                    ns_velocity <<= 2
-
-                if east_west_raw != 0:
-                    if self._get_msg_byte(5) & 0x04:
-                        ew_velocity = 0 - ew_velocity
-                    self.ew_velocity = ew_velocity
-
-                if north_south_raw != 0:
-                    if self._get_msg_byte(7) & 0x80:
-                        ns_velocity = 0 - ns_velocity
-                    self.ns_velocity = ns_velocity
-
-                if east_west_raw != 0 and north_south_raw != 0:
-                    velocity = math.sqrt((ns_velocity ** 2) + (ew_velocity ** 2))
-                    if self.cfg_use_metric:
-                        self['velocity'] = str(int(round(self.KPH_PER_KNOT * velocity)))
-                    else:
-                        self['velocity'] = str(int(round(velocity)))
-                    if velocity != 0:
-                        heading = math.atan2(ew_velocity, ns_velocity) * 180 / math.pi
-                        if heading < 0:
-                            heading += 360
-                        self['heading'] = str(int(round(heading)))
-            if 3 <= sub_type <= 4:
-                airspeed = ((self._get_msg_byte(7) & 0x7f) << 3) | (self._get_msg_byte(8) >> 5)
-                if airspeed != 0:
-                    airspeed -= 1
-                    if sub_type == 4:  # supersonic
-                        airspeed = airspeed << 2
-                    self['velocity'] = str(airspeed)
+    def decode_ADSB_msg(self):
+        self._run_decoders(TC_DECODERS.get(self.type_code, ()))
+
+    def decode_identification_msg(self):
+        self._set_call_sign()
+
+    def decode_velocity_msg(self):
+        sub_type = self._get_msg_byte(4) & 0x07
+        if 1 <= sub_type <= 4:
+            self.vertical_rate = self._get_vertical_rate()
+        if 1 <= sub_type <= 2:
+            east_west_raw = ((self._get_msg_byte(5) & 0x03) << 8) | self._get_msg_byte(6)
+            north_south_raw = ((self._get_msg_byte(7) & 0x7F) << 3) | (self._get_msg_byte(8) >> 5)
+            ew_velocity = east_west_raw - 1
+            ns_velocity = north_south_raw - 1
+
+            if sub_type == 2:
+                ew_velocity <<= 2
+                ns_velocity <<= 2
+
+            if east_west_raw != 0:
                 if self._get_msg_byte(5) & 0x04:
-                    self['heading'] = str(((((self._get_msg_byte(5) & 0x03) << 8) | self._get_msg_byte(6)) * 45) >> 7)
-
-        if self.TC_SURFACE_POS_5 <= self.type_code <= self.TC_AIRBORNE_POS_22:
-            if (self.TC_AIRBORNE_POS_9 <= self.type_code <= self.TC_AIRBORNE_POS_18) \
-                    or (self.TC_AIRBORNE_POS_20 <= self.type_code <= self.TC_AIRBORNE_POS_22):
-                self['altitude'] = str(self._get_altitude())
-                self.on_ground = False
-            elif self.TC_SURFACE_POS_5 <= self.type_code <= self.TC_SURFACE_POS_8:
-                self['velocity'] = str(self._get_velocity())
-                self['heading'] = str(self._get_heading())
-                self.on_ground = True
-
-            if (self.TC_AIRBORNE_POS_9 <= self.type_code <= self.TC_AIRBORNE_POS_18) \
-                    or (self.TC_AIRBORNE_POS_20 <= self.type_code <= self.TC_AIRBORNE_POS_22):
-                odd = True if (self._get_msg_byte(6) & 0x04) != 0 else False
-
-                lat = ((self._get_msg_byte(6) & 0x03) << 15) | \
-                      (self._get_msg_byte(7) << 7) | \
-                      (self._get_msg_byte(8) >> 1)
-                lon = ((self._get_msg_byte(8) & 0x01) << 16) | \
-                      (self._get_msg_byte(9) << 8) | \
-                      (self._get_msg_byte(10))
-
-                if odd:
-                    self.odd_time = time.time()
-                    self.odd_raw_latitude = lat
-                    self.odd_raw_longitude = lon
-                else:
-                    self.even_time = time.time()
-                    self.even_raw_latitude = lat
-                    self.even_raw_longitude = lon
-
-        if self.type_code == self.TC_RESERVED_TEST_23:
-            if sub_type == 7:
-                id_13 = (((self._get_msg_byte(5) << 8) | self._get_msg_byte(6)) & 0xFFF1) >> 3
-                if id_13 != 0:
-                    self['squawk'] = str("{:=04X}".format(parse_id13(id_13)))
-
-        if self.type_code == self.TC_EXT_SQ_AIRCRFT_STATUS_28:
-            if sub_type == 1:
-                id_13 = ((self._get_msg_byte(5) << 8) | self._get_msg_byte(6)) & 0x1FFF
-                if id_13 != 0:
-                    self['squawk'] = str("{:=04X}".format(parse_id13(id_13)))
+                    ew_velocity = 0 - ew_velocity
+                self.ew_velocity = ew_velocity
+
+            if north_south_raw != 0:
+                if self._get_msg_byte(7) & 0x80:
+                    ns_velocity = 0 - ns_velocity
+                self.ns_velocity = ns_velocity
+
+            if east_west_raw != 0 and north_south_raw != 0:
+                velocity = math.sqrt((ns_velocity ** 2) + (ew_velocity ** 2))
+                self.velocity = velocity
+                if velocity != 0:
+                    heading = math.atan2(ew_velocity, ns_velocity) * 180 / math.pi
+                    if heading < 0:
+                        heading += 360
+                    self.heading = heading
+        if 3 <= sub_type <= 4:
+            airspeed = ((self._get_msg_byte(7) & 0x7f) << 3) | (self._get_msg_byte(8) >> 5)
+            if airspeed != 0:
+                airspeed -= 1
+                if sub_type == 4:  # supersonic
+                    airspeed = airspeed << 2
+                self.velocity = airspeed
+            if self._get_msg_byte(5) & 0x04:
+                self.heading = ((((self._get_msg_byte(5) & 0x03) << 8) | self._get_msg_byte(6)) * 45) >> 7
+
+    def decode_surface_movement_msg(self):
+        self.velocity = self._get_velocity()
+        self.heading = self._get_heading()
+
+    def decode_surface_position_msg(self):
+        self.on_ground = True
+        self._set_cpr_raw()
+
+    def decode_airborne_altitude_msg(self):
+        self.altitude = self._get_altitude()
+
+    def decode_airborne_position_msg(self):
+        self.on_ground = False
+        self._set_cpr_raw()
+
+    def _set_cpr_raw(self):
+        # Surface and airborne positions have the cpr format and latitude/longitude in the same bits
+        odd = True if (self._get_msg_byte(6) & 0x04) != 0 else False
+
+        lat = ((self._get_msg_byte(6) & 0x03) << 15) | \
+              (self._get_msg_byte(7) << 7) | \
+              (self._get_msg_byte(8) >> 1)
+        lon = ((self._get_msg_byte(8) & 0x01) << 16) | \
+              (self._get_msg_byte(9) << 8) | \
+              (self._get_msg_byte(10))
+
+        if odd:
+            self.odd_time = time.time()
+            self.odd_raw_latitude = lat
+            self.odd_raw_longitude = lon
+        else:
+            self.even_time = time.time()
+            self.even_raw_latitude = lat
+            self.even_raw_longitude = lon
+
+    def decode_test_msg(self):
+        if self._get_msg_byte(4) & 0x07 == 7:
+            id_13 = (((self._get_msg_byte(5) << 8) | self._get_msg_byte(6)) & 0xFFF1) >> 3
+            if id_13 != 0:
+                self.squawk = parse_id13(id_13)
+
+    def decode_aircraft_status_msg(self):
+        if self._get_msg_byte(4) & 0x07 == 1:
+            id_13 = ((self._get_msg_byte(5) << 8) | self._get_msg_byte(6)) & 0x1FFF
+            if id_13 != 0:
+                self.squawk = parse_id13(id_13)
+
+    def decode_target_state_msg(self):
+        me = self._get_me()
+        if (me >> 49) & 0x03 == 1:
+            # MCP/FCU selected altitude in 32 ft steps, 0 is no data
+            selected_altitude = (me >> 36) & 0x7FF
+            if selected_altitude != 0:
+                self.selected_altitude = (selected_altitude - 1) * 32
+
+    def decode_operational_status_msg(self):
+        me = self._get_me()
+        if (me >> 48) & 0x07 <= 1:  # Airborne and surface status carry the version
+            self.adsb_version = (me >> 13) & 0x07
 
     def decode_extended_squitter_msg(self):
         if self.capability == 0 or self.capability == 1 or self.capability == 6:
             self.decode_ADSB_msg()
 
+    def _set_call_sign(self):
+        sign = callsign(self.msg, self.icao)
+        self.call_sign = sign if sign != "" else None
+        basic.statistics.add_flight(sign)
+
     def decode_comm_bds_reply_msg(self):
         if self._get_msg_byte(4) == 0x20:
-            self['call_sign'] = callsign(hex(self.msg)[2:-1])
-            basic.statistics.add_flight(self['call_sign'])
+            self._set_call_sign()
 
     def decode_altitude_msg(self):
         ac_13 = ((self._get_msg_byte(2) << 8) | self._get_msg_byte(3)) & 0x1FFF
         if ac_13 != 0:
-            altitude = parse_ac13(ac_13)
-            self['altitude'] = str(int(round(self.METER_PER_FOOT * altitude))) if self.cfg_use_metric else str(altitude)
+            self.altitude = parse_ac13(ac_13)
 
     def decode_identity_msg(self):
         if self.TC_ID_CAT_D_1 <= self.type_code <= self.TC_ID_CAT_A_4:
-            self['squawk'] = str("{:=04X}".format(self._get_identity()))
+            self.squawk = self._get_identity()
 
     def decode_comm_bds_identity_msg(self):
-        self['squawk'] = str("{:=04X}".format(self._get_identity()))
+        self.squawk = self._get_identity()
 
     def decode_flight_status_msg(self):
         self.flight_status = self._get_msg_byte(0) & 0x07
@@ -624,111 +1012,112 @@ class Squitter(basic.ADSB):
     def decode_all_reply_msg(self):
         pass  # Nothing to decode
 
-    def _update_statistics(self):
-        if self['downlink_format'] == self.DF_SHORT_AIR2AIR_SURVEILLANCE_0:
-            basic.statistics['df_0'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_1:
-            basic.statistics['df_1'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_2:
-            basic.statistics['df_2'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_3:
-            basic.statistics['df_3'] += 1
-        elif self['downlink_format'] == self.DF_SURVEILLANCE_ALTITUDE_REPLY_4:
-            basic.statistics['df_4'] += 1
-        elif self['downlink_format'] == self.DF_SURVEILLANCE_IDENTITY_REPLY_5:
-            basic.statistics['df_5'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_6:
-            basic.statistics['df_6'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_7:
-            basic.statistics['df_7'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_8:
-            basic.statistics['df_8'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_9:
-            basic.statistics['df_9'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_10:
-            basic.statistics['df_10'] += 1
-        elif self['downlink_format'] == self.DF_ALL_CALL_REPLY_11:
-            basic.statistics['df_11'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_12:
-            basic.statistics['df_12'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_13:
-            basic.statistics['df_13'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_14:
-            basic.statistics['df_14'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_15:
-            basic.statistics['df_15'] += 1
-        elif self['downlink_format'] == self.DF_LONG_AIR2AIR_SURVEILLANCE_16:
-            basic.statistics['df_16'] += 1
-        elif self['downlink_format'] == self.DF_ADSB_MSG_17:
-            basic.statistics['df_17'] += 1
-        elif self['downlink_format'] == self.DF_EXTENDED_SQUITTER_18:
-            basic.statistics['df_18'] += 1
-        elif self['downlink_format'] == self.DF_MILITARY_EXTENDED_SQUITTER_19:
-            basic.statistics['df_19'] += 1
-        elif self['downlink_format'] == self.DF_COMM_BDS_ALTITUDE_REPLY_20:
-            basic.statistics['df_20'] += 1
-        elif self['downlink_format'] == self.DF_COMM_BDS_IDENTITY_REPLY_21:
-            basic.statistics['df_21'] += 1
-        elif self['downlink_format'] == self.DF_MILITARY_USE_22:
-            basic.statistics['df_22'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_23:
-            basic.statistics['df_23'] += 1
-        elif self['downlink_format'] == self.DF_COMM_D_EXTENDED_LENGTH_MESSAGE_24:
-            basic.statistics['df_24'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_25:
-            basic.statistics['df_25'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_26:
-            basic.statistics['df_26'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_27:
-            basic.statistics['df_27'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_28:
-            basic.statistics['df_28'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_29:
-            basic.statistics['df_29'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_30:
-            basic.statistics['df_30'] += 1
-        elif self['downlink_format'] == self.DF_UNKNOWN_31:
-            basic.statistics['df_31'] += 1
-
-        basic.statistics['df_total'] += 1
+    def decode_comm_d_msg(self):
+        pass  # Extended length messages are not decoded
 
     def decode(self):
-        if self['ICAO24'] == "":  # if ICAO24 is already set we do not re-compute it here, see run in Radar
-            self['ICAO24'] = hex(((self._get_msg_byte(1) << 16)
-                                  | (self._get_msg_byte(2) << 8)
-                                  | self._get_msg_byte(3)))[2:].rstrip('L')
-            basic.statistics.add_icao(self['ICAO24'])
+        if self.icao is None:  # if ICAO24 is already set we do not re-compute it here, see run in Radar
+            self.icao = (self._get_msg_byte(1) << 16) | (self._get_msg_byte(2) << 8) | self._get_msg_byte(3)
+            basic.statistics.add_icao(self.icao)
 
         self.capability = self._get_msg_byte(0) & 0x07
         self.type_code = self._get_msg_byte(4) >> 3
         self.emitter_category = self._get_msg_byte(4) & 0x07
         self.parity = self.msg & 0xFFFFFF
 
-        if self['downlink_format'] == self.DF_SHORT_AIR2AIR_SURVEILLANCE_0:
-            self.decode_altitude_msg()
-        elif self['downlink_format'] == self.DF_SURVEILLANCE_ALTITUDE_REPLY_4:
-            self.decode_altitude_msg()
-            self.decode_flight_status_msg()
-        elif self['downlink_format'] == self.DF_SURVEILLANCE_IDENTITY_REPLY_5:
-            self.decode_identity_msg()
-            self.decode_flight_status_msg()
-        elif self['downlink_format'] == self.DF_ALL_CALL_REPLY_11:
-            self.decode_all_reply_msg()
-        elif self['downlink_format'] == self.DF_LONG_AIR2AIR_SURVEILLANCE_16:
-            self.decode_altitude_msg()
-        elif self['downlink_format'] == self.DF_ADSB_MSG_17:
-            self.decode_ADSB_msg()
-        elif self['downlink_format'] == self.DF_EXTENDED_SQUITTER_18:
-            self.decode_extended_squitter_msg()
-        elif self['downlink_format'] == self.DF_COMM_BDS_ALTITUDE_REPLY_20:
-            self.decode_comm_bds_reply_msg()
-            self.decode_altitude_msg()
-            self.decode_flight_status_msg()
-        elif self['downlink_format'] == self.DF_COMM_BDS_IDENTITY_REPLY_21:
-            self.decode_comm_bds_reply_msg()
-            self.decode_comm_bds_identity_msg()
-            self.decode_flight_status_msg()
+        decoders = DF_DECODERS.get(self.downlink_format)
+        if decoders is None:
+            self.logger.info("decode, unknown downlink format: {}".format(self.downlink_format))
         else:
-            self.logger.info("decode, unknown downlink format: {}".format(self['downlink_format']))
+            self._run_decoders(decoders)
+
+        basic.statistics.count_df(self.downlink_format)
+
+
+# Squitter.decode calls the decoders registered for the downlink format, decode_ADSB_msg those for the type code,
+# in the order registered. Other message types are added by registering a decoder for them.
+DF_DECODERS = {}
+TC_DECODERS = {}
+LAZY_DECODERS = {}  # decoder: names of the values it sets
+_lazy_split = {}  # decoders: (decoders run at once, decoders deferred), in lazy decode mode
+
+
+def _functions(decoders):
+    # Store plain functions, they are called with the Squitter as argument
+    return tuple(getattr(decoder, 'im_func', decoder) for decoder in decoders)
+
+
+def _register(table, keys, decoders):
+    if isinstance(keys, (int, long)):
+        keys = (keys,)
+    decoders = _functions(decoders)
+    for key in keys:
+        table[key] = table.get(key, ()) + decoders
+
 
-        self._update_statistics()
+def register_df(downlink_formats, *decoders):
+    """
+    Register decoders for a downlink format, or an iterable of them. A decoder is a Squitter method, or a function
+    taking the Squitter, that sets the decoded values.
+    """
+    _register(DF_DECODERS, downlink_formats, decoders)
+    _lazy_split.clear()
+
+
+def register_tc(type_codes, *decoders):
+    """
+    Register decoders for an extended squitter type code, or an iterable of them
+    """
+    _register(TC_DECODERS, type_codes, decoders)
+    _lazy_split.clear()
+
+
+def register_lazy(names, *decoders):
+    """
+    Register decoders that only set values which are shown, not used for tracking (ICAO, cpr positions), names are
+    the Squitter values they set. In lazy decode mode they are deferred until the values are read, see
+    Squitter.resolve.
+    """
+    for decoder in _functions(decoders):
+        LAZY_DECODERS[decoder] = tuple(names)
+    _lazy_split.clear()
+
+
+register_df(basic.ADSB.DF_SHORT_AIR2AIR_SURVEILLANCE_0, Squitter.decode_altitude_msg)
+register_df(basic.ADSB.DF_SURVEILLANCE_ALTITUDE_REPLY_4, Squitter.decode_altitude_msg,
+            Squitter.decode_flight_status_msg)
+register_df(basic.ADSB.DF_SURVEILLANCE_IDENTITY_REPLY_5, Squitter.decode_identity_msg,
+            Squitter.decode_flight_status_msg)
+register_df(basic.ADSB.DF_ALL_CALL_REPLY_11, Squitter.decode_all_reply_msg)
+register_df(basic.ADSB.DF_LONG_AIR2AIR_SURVEILLANCE_16, Squitter.decode_altitude_msg)
+register_df(basic.ADSB.DF_ADSB_MSG_17, Squitter.decode_ADSB_msg)
+register_df(basic.ADSB.DF_EXTENDED_SQUITTER_18, Squitter.decode_extended_squitter_msg)
+register_df(basic.ADSB.DF_COMM_BDS_ALTITUDE_REPLY_20, Squitter.decode_comm_bds_reply_msg, Squitter.decode_altitude_msg,
+            Squitter.decode_flight_status_msg)
+register_df(basic.ADSB.DF_COMM_BDS_IDENTITY_REPLY_21, Squitter.decode_comm_bds_reply_msg,
+            Squitter.decode_comm_bds_identity_msg, Squitter.decode_flight_status_msg)
+# Only the first 2 bits are the DF of an extended length message, so it is any of 24 to 31
+register_df(range(basic.ADSB.DF_COMM_D_EXTENDED_LENGTH_MESSAGE_24, basic.ADSB.DF_UNKNOWN_31 + 1),
+            Squitter.decode_comm_d_msg)
+
+register_tc(range(basic.ADSB.TC_ID_CAT_D_1, basic.ADSB.TC_ID_CAT_A_4 + 1), Squitter.decode_identification_msg)
+register_tc(range(basic.ADSB.TC_SURFACE_POS_5, basic.ADSB.TC_SURFACE_POS_8 + 1), Squitter.decode_surface_movement_msg,
+            Squitter.decode_surface_position_msg)
+register_tc(range(basic.ADSB.TC_AIRBORNE_POS_9, basic.ADSB.TC_AIRBORNE_POS_18 + 1) +
+            range(basic.ADSB.TC_AIRBORNE_POS_20, basic.ADSB.TC_AIRBORNE_POS_22 + 1),
+            Squitter.decode_airborne_altitude_msg, Squitter.decode_airborne_position_msg)
+register_tc(basic.ADSB.TC_AIRBORNE_VELOCITY_19, Squitter.decode_velocity_msg)
+register_tc(basic.ADSB.TC_RESERVED_TEST_23, Squitter.decode_test_msg)
+register_tc(basic.ADSB.TC_EXT_SQ_AIRCRFT_STATUS_28, Squitter.decode_aircraft_status_msg)
+register_tc(basic.ADSB.TC_TARGET_STATE_STATUS_29, Squitter.decode_target_state_msg)
+register_tc(basic.ADSB.TC_AIRCRAFT_OPERAIONAL_STATUS_31, Squitter.decode_operational_status_msg)
+
+# Call signs are decoded at once, they are counted by the statistics and the flight db
+register_lazy(('altitude',), Squitter.decode_altitude_msg, Squitter.decode_airborne_altitude_msg)
+register_lazy(('squawk',), Squitter.decode_identity_msg, Squitter.decode_comm_bds_identity_msg,
+              Squitter.decode_test_msg, Squitter.decode_aircraft_status_msg)
+register_lazy(('flight_status',), Squitter.decode_flight_status_msg)
+register_lazy(('velocity', 'heading', 'vertical_rate'), Squitter.decode_velocity_msg)
+register_lazy(('velocity', 'heading'), Squitter.decode_surface_movement_msg)
+register_lazy(('selected_altitude',), Squitter.decode_target_state_msg)
+register_lazy(('adsb_version',), Squitter.decode_operational_status_msg)
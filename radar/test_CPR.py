@@ -50,14 +50,52 @@ def main():
 
     m3 = [0, 0x8D40621D58C382D690C8AC2863A7]
     Sq3 = squitter.Squitter()
-    Sq3.cfg_latitude = 52.258
-    Sq3.cfg_longitude = 3.918
     Sq3.parse(m3)
     Sq3.decode()
     if Sq3.decodeCPR_relative():
         print "latitude: {} longitude: {}".format(Sq3['latitude'], Sq3['longitude'])
         print "Expected latitude: 52.25720 longitude: 3.91937"
 
+    # Local decoding against the receiver position, from one message
+    squitter.Squitter.cfg_latitude = 52.258
+    squitter.Squitter.cfg_longitude = 3.918
+    Sq4 = squitter.Squitter()
+    Sq4.parse(m3)
+    Sq4.decode()
+    if Sq4.decodeCPR_local():
+        print "latitude: {} longitude: {}".format(Sq4['latitude'], Sq4['longitude'])
+        print "Expected latitude: 52.257 longitude: 3.919"
+
+    # Surface position, needs a reference
+    squitter.Squitter.cfg_latitude = 51.990
+    squitter.Squitter.cfg_longitude = 4.375
+    Sq5 = squitter.Squitter()
+    Sq5.parse([0, 0x8C4841753A9A153237AEF0F275BE])
+    Sq5.decode()
+    if Sq5.decodeCPR_local():
+        print "latitude: {} longitude: {}".format(Sq5['latitude'], Sq5['longitude'])
+        print "Expected latitude: 52.321 longitude: 4.736"
+
+    # The same surface message with the receiver 81 km away, just past the surface max range. Within the airborne max
+    # range, but surface zones are smaller so the position is rejected
+    squitter.Squitter.cfg_latitude = 51.590
+    squitter.Squitter.cfg_longitude = 4.736
+    squitter.Squitter.cfg_local_cpr_surface_max_range = 80
+    Sq6 = squitter.Squitter()
+    Sq6.parse([0, 0x8C4841753A9A153237AEF0F275BE])
+    Sq6.decode()
+    print "Surface position 81 km away accepted: {}".format(Sq6.decodeCPR_local())
+    print "Expected accepted: False"
+
+    if squitter.np is not None:
+        # The first two examples again, as one batch
+        latitude, longitude, valid = squitter.decodeCPR_batch([93000, 92095], [51372, 39846],
+                                                              [74158, 88385], [50194, 125818], [2, 2], [1, 1])
+        for lat, lon, ok in zip(latitude, longitude, valid):
+            if ok:
+                print "Batch latitude: {} longitude: {}".format(round(lat, 3), round(lon, 3))
+        print "Expected latitude: 52.257 longitude: 3.919 and latitude: 10.216 longitude: 123.889"
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,101 @@
+import random
+import sys
+import basic
+import squitter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def bitwise_crc(msg, no_of_bits):
+    """
+    Reference syndrome, the remainder of the message divided by the GENERATOR polynom one bit at a time
+    """
+    polynom = int(basic.ADSB.GENERATOR, base=2)
+    for bit in range(no_of_bits - 1, 23, -1):
+        if msg & (1 << bit):
+            msg ^= polynom << (bit - 24)
+    return msg & 0xFFFFFF
+
+
+def random_frames(count):
+    # Long frames start with a 1 bit and short frames with a 0 bit, as crc_batch tells them apart
+    frames = []
+    for _ in range(count):
+        if random.random() < 0.5:
+            frames.append((random.getrandbits(111) | (1 << 111), basic.ADSB.MODES_LONG_MSG_BITS))
+        else:
+            frames.append((random.getrandbits(55), basic.ADSB.MODES_SHORT_MSG_BITS))
+    return frames
+
+
+def to_bytes(msg, no_of_bits):
+    return bytearray('{:0{}x}'.format(msg, no_of_bits / 4).decode('hex'))
+
+
+def check_correction():
+    """
+    Squitter.parse restores a DF17 message with 1 or 2 flipped bits through the syndrome tables, and counts a message
+    it can't correct in not_corrected
+    """
+    valid = 0x8D4840D6202CC371C32CE0576098
+    squitter.Squitter.cfg_apply_bit_err_correction = True
+    failures = 0
+    for bits, errors, counter in ((1, [60], 'corrected_1_bit'), (2, [20, 97], 'corrected_2_bit'),
+                                  (1, [30, 31, 70], 'not_corrected')):
+        squitter.Squitter.cfg_bit_err_correction = {basic.ADSB.DF_ADSB_MSG_17: bits}
+        msg = valid
+        for error in errors:
+            msg ^= 1 << (basic.ADSB.MODES_LONG_MSG_BITS - 1 - error)
+        count = basic.statistics[counter]
+
+        Sq = squitter.Squitter()
+        Sq.parse([0, msg])
+        corrected = Sq.crc_ok and Sq.msg == valid
+        expected = counter != 'not_corrected'
+        print "{} bit errors, correcting {} bits: corrected {}, {} counted {}".format(
+            len(errors), bits, corrected, counter, basic.statistics[counter] - count)
+        if corrected != expected or basic.statistics[counter] != count + 1:
+            print "FAILED: expected corrected {}".format(expected)
+            failures += 1
+    return failures
+
+
+def main():
+    random.seed(1090)
+    adsb = basic.ADSB()
+    frames = random_frames(2000)
+    failures = 0
+
+    reference = [bitwise_crc(msg, bits) for msg, bits in frames]
+    table = [adsb.crc(msg, bits) for msg, bits in frames]
+    from_bytes = [adsb.crc_bytes(to_bytes(msg, bits)) for msg, bits in frames]
+    print "crc: {} of {} differ from the bitwise crc".format(sum(a != b for a, b in zip(table, reference)), len(frames))
+    print "crc_bytes: {} of {} differ".format(sum(a != b for a, b in zip(from_bytes, reference)), len(frames))
+    failures += table != reference
+    failures += from_bytes != reference
+
+    if np is not None:
+        rows = np.zeros((len(frames), basic.ADSB.MODES_LONG_MSG_BYTES), dtype=np.uint8)
+        for row, (msg, bits) in zip(rows, frames):
+            data = to_bytes(msg, bits)
+            row[:len(data)] = np.frombuffer(str(data), dtype=np.uint8)
+        batch = basic.ADSB.crc_batch(rows).tolist()
+        print "crc_batch: {} of {} differ".format(sum(a != b for a, b in zip(batch, reference)), len(frames))
+        failures += batch != reference
+
+    # A known good DF17 message
+    if adsb.crc(0x8D4840D6202CC371C32CE0576098) != 0:
+        print "FAILED: crc of a valid message is not 0"
+        failures += 1
+
+    failures += check_correction()
+
+    print "All crc checks passed" if failures == 0 else "{} checks failed".format(failures)
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+import random
+import sys
+import squitter
+
+
+def check_tables():
+    """
+    Every entry of the lookup tables, through the public decoders and their *_array variants, against the formula
+    """
+    checks = (('parse_id13', squitter.parse_id13, squitter._parse_id13, 1 << 13),
+              ('ModeA_2_ModeC', squitter.ModeA_2_ModeC, squitter._ModeA_2_ModeC, 1 << 16),
+              ('parse_ac13', squitter.parse_ac13, squitter._parse_ac13, 1 << 13),
+              ('parse_ac12', squitter.parse_ac12, squitter._parse_ac12, 1 << 12),
+              ('parse_movement', squitter.parse_movement, squitter._parse_movement, 1 << 7))
+    failures = 0
+    for name, func, formula, size in checks:
+        expected = [formula(field) for field in xrange(size)]
+        differ = sum(func(field) != value for field, value in zip(xrange(size), expected))
+        if squitter.np is not None:
+            array_func = getattr(squitter, name + '_array')
+            differ += sum(a != b for a, b in zip(array_func(squitter.np.arange(size)).tolist(), expected))
+        print "{}: {} of {} entries differ".format(name, differ, size)
+        failures += differ != 0
+    return failures
+
+
+def reference_callsign(msg):
+    """
+    The call sign decoded through a binary string, as spots did before callsign used integer shifts
+    """
+    csbin = bin(msg)[2:].zfill(112)[40:88]
+    sign = ''.join(squitter.CALLSIGN_CHARS[int(csbin[ind:ind + 6], 2)] for ind in range(0, 48, 6))
+    return sign.translate(None, '#_')
+
+
+def check_callsign():
+    """
+    callsign, with and without the cache, and callsign_batch against a known call sign and the reference
+    """
+    failures = 0
+    known = 0x8D4840D6202CC371C32CE0576098
+    print "Call sign: {}".format(squitter.callsign(known))
+    print "Expected call sign: KLM1023"
+    failures += squitter.callsign(known) != 'KLM1023'
+
+    random.seed(1090)
+    msgs = [known] + [random.getrandbits(112) for _ in range(2000)]
+    expected = [reference_callsign(msg) for msg in msgs]
+    signs = [squitter.callsign(msg) for msg in msgs]
+    # Each message twice with the cache, the first call replaces the cached sign of the icao and the second uses it
+    cached = [squitter.callsign(msg, icao=num % 10) for num, msg in enumerate(msgs) for _ in range(2)]
+    differ = sum(a != b for a, b in zip(signs, expected))
+    differ += sum(a != b for a, b in zip(cached, [sign for sign in expected for _ in range(2)]))
+    if squitter.np is not None:
+        frames = squitter.np.array([bytearray('{:028x}'.format(msg).decode('hex')) for msg in msgs],
+                                   dtype=squitter.np.uint8)
+        differ += sum(a != b for a, b in zip(squitter.callsign_batch(frames), expected))
+    print "callsign: {} of {} call signs differ from the reference".format(differ, len(msgs))
+    failures += differ != 0
+    return failures
+
+
+def main():
+    failures = check_tables()
+    failures += check_callsign()
+    print "All decode checks passed" if failures == 0 else "{} checks failed".format(failures)
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,33 @@
+import sys
+import numpy as np
+import tuner
+
+
+def main():
+    # The numpy detection (_detect_adsb_batch) must find the same messages as the scalar scan of _detect_adsb.
+    # Run from this directory, on the recording modes1.bin
+    Tn = tuner.Tuner(filename='modes1.bin')
+    Tn.cfg_check_phase = False  # The batch path is only used without phase check
+
+    sig = Tn._iq_to_uint(Tn._iq_to_words(np.fromfile('modes1.bin', dtype=np.uint8)))
+
+    batch, batch_positions, batch_ind = Tn._detect_adsb(sig)
+    scalar, scalar_positions, scalar_ind = Tn._detect_adsb(sig.tolist())
+
+    print "Batch: {} messages, scalar: {} messages".format(len(batch), len(scalar))
+    failures = 0
+    if batch_positions != scalar_positions:
+        print "FAILED: positions differ"
+        failures += 1
+    if [elem[:2] for elem in batch] != scalar:
+        print "FAILED: signal strengths or messages differ"
+        failures += 1
+    if batch_ind != scalar_ind:
+        print "FAILED: scan stopped at {}, expected {}".format(batch_ind, scalar_ind)
+        failures += 1
+    print "Batch and scalar detection are the same" if failures == 0 else "{} checks failed".format(failures)
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(main())
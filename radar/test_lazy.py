@@ -0,0 +1,102 @@
+import sys
+import numpy as np
+import basic
+import squitter
+import tuner
+
+# The values compared, the shown values and those only decoded when shown in lazy decode mode
+VALUES = ('signal_strength', 'downlink_format', 'icao', 'squawk', 'altitude', 'call_sign', 'velocity', 'heading',
+          'latitude', 'longitude', 'vertical_rate', 'flight_status', 'selected_altitude', 'adsb_version')
+
+
+def tracks(frames, lazy):
+    """
+    Decode the frames and merge them per aircraft as Radar does, in lazy or eager decode mode
+    """
+    squitter.Squitter.cfg_lazy_decode = lazy
+    result = {}
+    for frame in frames:
+        msg = squitter.Squitter()
+        msg.parse(frame)
+        if msg.msg == 0:
+            continue
+        if not msg.crc_ok:
+            if msg.downlink_format in (basic.ADSB.DF_ALL_CALL_REPLY_11, basic.ADSB.DF_ADSB_MSG_17,
+                                       basic.ADSB.DF_EXTENDED_SQUITTER_18) or msg.crc_sum not in result:
+                continue
+            msg.icao = msg.crc_sum  # The ICAO address is xor'ed with the crc
+        msg.decode()
+        if msg.icao in result:
+            result[msg.icao].update(msg)
+        else:
+            result[msg.icao] = msg
+    for track in result.values():
+        track.resolve()
+    return result
+
+
+def values(track):
+    return dict((name, getattr(track, name)) for name in VALUES)
+
+
+def check_recording():
+    # Run from this directory, on the recording modes1.bin
+    Tn = tuner.Tuner(filename='modes1.bin')
+    Tn.cfg_check_phase = False
+    sig = Tn._iq_to_uint(Tn._iq_to_words(np.fromfile('modes1.bin', dtype=np.uint8)))
+    frames = list(Tn._detect_adsb(sig)[0])
+
+    eager = tracks(frames, False)
+    lazy = tracks(frames, True)
+    failures = 0
+    for icao in sorted(eager):
+        print "{:x} eager: {}".format(icao, values(eager[icao]))
+        if icao not in lazy or values(lazy[icao]) != values(eager[icao]):
+            print "{:x} lazy:  {}".format(icao, values(lazy[icao]) if icao in lazy else None)
+            print "FAILED: lazy and eager values differ"
+            failures += 1
+    return failures
+
+
+def check_zero_values():
+    """
+    A value of 0 in the newest message is shown, not an older value: vertical rate 0 ft/min and flight status 0
+    """
+    icao = 0x485020
+    velocity = 0x8D485020994409940838175B284F  # Vertical rate -832 ft/min
+    # The same message with vertical rate 0: the sign and the 9 bits raw vertical rate, bits 68 to 77, set to 1
+    level = velocity & ~(0x3FF << 34) | (1 << 34)
+    frames = [[0, (0x20 | 2) << 104 | icao << 24],  # DF4, flight status 2 and no altitude
+              [0, velocity], [0, (0x20 | 0) << 104 | icao << 24], [0, level]]
+
+    failures = 0
+    for lazy in (False, True):
+        squitter.Squitter.cfg_lazy_decode = lazy
+        track = None
+        for frame in frames:
+            msg = squitter.Squitter()
+            msg.parse(frame)
+            msg.icao = icao  # The crc of the DF4 frames is not valid
+            msg.decode()
+            if track is None:
+                track = msg
+            else:
+                track.update(msg)
+        track.resolve()
+        print "{}: vertical rate {} flight status {}".format("Lazy" if lazy else "Eager", track.vertical_rate,
+                                                             track.flight_status)
+        if track.vertical_rate != 0 or track.flight_status != 0:
+            print "FAILED: expected vertical rate 0 flight status 0"
+            failures += 1
+    return failures
+
+
+def main():
+    failures = check_recording()
+    failures += check_zero_values()
+    print "Lazy and eager decoding are the same" if failures == 0 else "{} checks failed".format(failures)
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,22 @@
 import basic
 import Queue
+import collections
+import ctypes
 import logging
 import math
-import struct
+import mmap
+import multiprocessing
+import os
 import threading
 import rtlsdr
 import time
 import signal
 
+try:
+    import numpy as np
+except ImportError:
+    np = None  # Samples are converted using plain lists, see _sdr_cb
+
 __author__ = 'Wolfrax'
 
 """
@@ -17,10 +26,24 @@ This module have one object - Tuner, when initialized it create an RtlSdr object
 The pyrtlsdr library is a wrapper for rtlsdr.
 See http://osmocom.org/projects/sdr/wiki/rtl-sdr and https://github.com/roger-/pyrtlsdr
 
+When reading from file the file is memory mapped and streamed through the same callback in chunks of MODES_DATA_LEN
+bytes until end of file, so long recordings can be replayed with constant memory use.
+
 When the tuner is started it runs as a separate thread that detects squitter messages, these are added
-to an internal message queue for others to consume. As the queue is limited it will raise an exception
-when the queue is full.
+to an internal message queue (BufferRing) for others to consume. As the queue is limited, buffers or messages are shed
+according to the overload policy when the queue is full.
 The consumer thread uses the tuner read methods to get queued messages
+
+If numpy is installed the conversion from IQ samples to magnitudes is done on arrays, otherwise plain lists are used.
+
+The detection can't scan the last SQUITTER_LONG_MAX_SIZE samples of a buffer, a message starting there would be cut.
+These samples are carried over and prepended to the next buffer so that messages straddling two buffers are found.
+
+The detected messages are timestamped in ticks of a 12 MHz clock (as the Beast format), counted from the position of
+the message in the stream of samples since start.
+
+With "demod workers" configured (requires numpy) the demodulation is done by a DemodPool of worker processes instead,
+the tuner thread only copies the raw buffers into shared memory. The GIL otherwise limits the decoding to one core.
 """
 
 
@@ -36,6 +59,9 @@ class Tuner(basic.ADSB, threading.Thread):
     
     Another thread use the read method to retrieve the samples stored in the data-queue for further processing
     """
+
+    CLOCK = 12.0e6  # Hz, of the message timestamps
+
     def __init__(self, sr=2.0e6, cf=1090e6, gain='max', filename=None):
         threading.Thread.__init__(self, name="Tuner")
         basic.ADSB.__init__(self)
@@ -50,6 +76,7 @@ class Tuner(basic.ADSB, threading.Thread):
         self.logger.info("Tuner initializing")
 
         self.sdr_async_ts = 0.0
+        self.sample_rate = sr
         if filename is None:
             self.sdr = rtlsdr.RtlSdr()
             self.sdr.DEFAULT_ASYNC_BUF_NUMBER = self.MODES_ASYNC_BUF_NUMBER
@@ -61,7 +88,11 @@ class Tuner(basic.ADSB, threading.Thread):
             self.sdr.set_agc_mode(0)
             self.logger.info("Tuner initialised to gain {}".format(self.sdr.gain))
 
-        self.data = Queue.Queue(self.MODES_ASYNC_BUF_NUMBER)
+        # When replaying a file the tuner waits for the consumer rather than shedding. A merged item holds at most
+        # as many messages as fit in one buffer
+        self.data = BufferRing(self.MODES_ASYNC_BUF_NUMBER, self.cfg_overload_policy, self.cfg_overload_priority_df,
+                               block=filename is not None, finished=self.finished,
+                               max_merge=self.MODES_DATA_LEN / 2 / self.SQUITTER_SHORT_MAX_SIZE)
         self._cb_func = None
 
         # Each I and Q value varies from 0 to 255, which represents a range from -1 to +1. To get from the
@@ -98,24 +129,63 @@ class Tuner(basic.ADSB, threading.Thread):
                      for q in range(256)] for i in range(256)]
         self.LUT = [map((lambda x: x if x < self.MODES_SIGMAX else self.MODES_SIGMAX), elem) for elem in self.LUT]
 
+        # The same table flattened, indexed directly by the 16-bit word (q << 8) | i, used for the numpy conversion
+        self.LUT_flat = np.array(self.LUT, dtype=np.uint16).ravel() if np is not None else None
+
+        # Magnitudes carried over from the previous buffer. With numpy they are kept first in a ring that is allocated
+        # once, the magnitudes of the next buffer are written right after them
+        self._carry = []
+        self._carry_len = 0
+        self._carry_start = 0  # Where to continue the preamble scan among the carried over samples
+        self._samples = 0  # Samples before the current buffer, for the timestamps
+        if np is not None:
+            self._ring = np.zeros(self.SQUITTER_LONG_MAX_SIZE + self.MODES_DATA_LEN / 2, dtype=np.uint16)
+
         self.filename = filename
-        self.sig = []
+        self.eof = threading.Event()  # Set when the file has been read to the end
+        self._file = None
+        self._mm = None
 
         if self.filename is not None:
-            with open(self.filename, "r") as f:
-                iq = f.read(1)
-                while iq != "" and len(self.sig) < self.MODES_DATA_LEN:
-                    self.sig.append(struct.unpack('B', iq)[0])
-                    iq = f.read(1)
+            self._file = open(self.filename, "rb")
+            if os.fstat(self._file.fileno()).st_size > 0:  # An empty file can't be mapped
+                self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # The worker processes are forked here, before the other threads of spots are started
+        self.pool = None
+        if self.cfg_demod_workers > 0:
+            if np is not None and not self.cfg_check_phase:
+                self.pool = DemodPool(self, self.cfg_demod_workers)
+            else:
+                self.logger.info("Tuner demod workers need numpy and no phase check, not used")
 
         self.logger.info("Tuner initializing done")
 
-    def _iq_to_uint(self, sig):
+    @staticmethod
+    def _iq_to_words(samples):
+        """
+        View the raw byte buffer (i-value followed by q-value) as little endian unsigned shorts without copying,
+        the result is a numpy array with the i-value in the LSB and the q-value in the MSB
+        """
+        if isinstance(samples, np.ndarray):
+            raw = samples
+        elif isinstance(samples, list):
+            raw = np.array(samples, dtype=np.uint8)
+        else:
+            raw = np.frombuffer(samples, dtype=np.uint8)
+        return raw[:len(raw) & ~1].view('<u2')  # A trailing odd byte is ignored, as in the list conversion
+
+    def _iq_to_uint(self, sig, out=None):
+        if np is not None:
+            return self.LUT_flat.take(sig, out=out)  # One batched gather into a contiguous array
         return [self.LUT[sig[ind] / 256][sig[ind] % 256] for ind in range(len(sig))]
 
     def run(self):
         self.logger.info("Tuner start reading")
 
+        if self.pool is not None:
+            self.pool.start()
+
         if self.filename is None:
             # DEFAULT_ASYNC_BUF_NUMBER is the number of elements in the ring buffer within librtlsdr c-implementation
             # pyrtlsdr sets this to 15. This means that the callback function (signal) is called
@@ -143,27 +213,112 @@ class Tuner(basic.ADSB, threading.Thread):
                     self.logger.info("Tuner no luck to re-initialised...time to die")
                     self.die()
         else:
-            self._sdr_cb(self.sig, None)
+            self._read_file()
+
+    def _read_file(self):
+        """
+        Stream the memory mapped file through the callback in chunks of MODES_DATA_LEN bytes until end of file.
+        With numpy the chunks are views into the mapping (no copy), pages are mapped in by the OS as they are read.
+        """
+        size = len(self._mm) if self._mm is not None else 0
+        for offset in xrange(0, size, self.MODES_DATA_LEN):
+            if self.finished.is_set():
+                break
+            length = min(self.MODES_DATA_LEN, size - offset)
+            if np is not None:
+                chunk = np.frombuffer(self._mm, dtype=np.uint8, count=length, offset=offset)
+            else:
+                chunk = bytearray(self._mm[offset:offset + length])
+            self._sdr_cb(chunk, None)
+            del chunk  # Do not keep a reference into the mapping, it is closed below
+
+        if self.pool is not None:
+            self.pool.drain()  # eof is not set until the workers are done with the buffers
+
+        if self._mm is not None:
+            self._mm.close()
+        self._file.close()
+
+        self.logger.info("Tuner read {} bytes from {}".format(size, self.filename))
+        self.eof.set()
 
     def _sdr_cb(self, samples, context):
-        try:
-            # Samples are returned as unsigned bytes with i-value followed by q-value
-            # Below we we create an unsigned short with i-value in the MSB followed q-value in LSB
+        start = time.time()
+        if self.pool is not None:
+            self.pool.submit(samples)
+            basic.budget.add('uint', time.time() - start)
+            return
 
-            samples = [((samples[ind+1] << 8) | samples[ind]) for ind in range(0, len(samples) - 1, 2)]
-            samples = self._iq_to_uint(samples)
-
-            adsb_samples = self._detect_adsb(samples)  # This is where we scan for the preamble
-            basic.statistics['valid_preambles'] += len(adsb_samples)
-            self.data.put(adsb_samples)
+        # Samples are returned as unsigned bytes with i-value followed by q-value
+        # Below we we create an unsigned short with q-value in the MSB followed i-value in LSB
 
-        except Queue.Full:
-            self.logger.error('Queue is full!')
-            self.die()
+        if np is not None:
+            samples = self._iq_to_words(samples)
+        else:
+            samples = [((samples[ind+1] << 8) | samples[ind]) for ind in range(0, len(samples) - 1, 2)]
+        duration = len(samples) / self.sample_rate
+        words_ts = time.time()
+        samples = self._add_carry(samples)
+        magnitude_ts = time.time()
+
+        # This is where we scan for the preamble
+        adsb_samples, positions, next_ind = self._detect_adsb(samples, self._carry_start)
+        basic.statistics['valid_preambles'] += len(adsb_samples)
+        basic.statistics['carry_over_frames'] += len([pos for pos in positions if pos < self._carry_len])
+        self.stamp(adsb_samples, positions, self._samples - self._carry_len)
+        self._samples += len(samples) - self._carry_len
+        self._save_carry(samples, next_ind)
+        basic.budget.add_stages(uint=words_ts - start, magnitude=magnitude_ts - words_ts,
+                                detect=time.time() - magnitude_ts)
+
+        self.data.put(adsb_samples)  # Never blocks the sdr callback, sheds when full
+        basic.budget.buffer_done(duration)
+
+    def stamp(self, frames, positions, first):
+        """
+        Set the timestamps of the frames, positions are their sample index in a buffer where first is the number of
+        the first sample since start
+        """
+        ticks = self.CLOCK / self.sample_rate
+        timestamps = [int((first + pos) * ticks) for pos in positions]
+        if isinstance(frames, basic.FrameBatch):
+            frames.timestamps = timestamps
+        else:
+            for frame, timestamp in zip(frames, timestamps):
+                frame.extend((None, timestamp))  # No crc syndrome computed, see Squitter.parse
+
+    def _add_carry(self, words):
+        """
+        Convert words to magnitudes and return them preceded by the samples carried over from the previous buffer
+        """
+        if np is None:
+            return self._carry + self._iq_to_uint(words)
+
+        length = self._carry_len + len(words)
+        if length > len(self._ring):  # Only if the buffer is larger than MODES_DATA_LEN
+            ring = np.zeros(length, dtype=np.uint16)
+            ring[:self._carry_len] = self._ring[:self._carry_len]
+            self._ring = ring
+        self._iq_to_uint(words, out=self._ring[self._carry_len:length])
+        return self._ring[:length]
+
+    def _save_carry(self, sig, next_ind):
+        """
+        Keep the samples the scan did not reach, and where to continue the scan, for the next buffer
+        """
+        keep = min(self.SQUITTER_LONG_MAX_SIZE, len(sig))
+        if np is None:
+            self._carry = sig[len(sig) - keep:]
+        else:
+            self._ring[:keep] = sig[len(sig) - keep:].copy()  # sig is a view of the ring, the slices may overlap
+        self._carry_len = keep
+        self._carry_start = max(0, next_ind - (len(sig) - keep))
 
     def die(self):
         self.logger.info("Tuner dying...")
         self.finished.set()
+        if self.pool is not None:
+            self.pool.close()
         if self._cb_func is not None:
             self._cb_func(None, stop=True)
         if self.filename is None:
@@ -182,14 +337,305 @@ class Tuner(basic.ADSB, threading.Thread):
                 try:
                     msgs = self.data.get(timeout=1.0)  # Timeout after 1 sec to ensure we are not blocked forever
                 except Queue.Empty:
-                    continue  # So we got a timeout from the Queue, continue to execute
-
-                self._cb_func(msgs)
+                    pass  # So we got a timeout from the Queue, continue to execute
+                else:
+                    self._cb_func(msgs)
 
                 if not self.cfg_run_as_daemon:
-                    # If we are reading from file, sleep for 2 secs to allow for printout, then raise exception and die
-                    if self.cfg_read_from_file and not self.cfg_use_text_display:
+                    # If we have read the whole file, sleep for 2 secs to allow for printout, then raise exception and die
+                    if self.cfg_read_from_file and not self.cfg_use_text_display and \
+                            self.eof.is_set() and self.data.empty():
                         time.sleep(2)
                         self.die()
         except KeyboardInterrupt:
             self.die()
+
+
+class BufferRing:
+    """
+    The bounded queue of detected messages, one item (a FrameBatch or a list) per tuner buffer
+
+    When the ring is full, put sheds according to the policy rather than blocking the tuner:
+        drop-oldest: the oldest item is dropped to make room for the new
+        drop-newest: the new item is dropped
+        drop-low-priority: the messages of the oldest item with a downlink format not in priority_df are dropped, the
+                           remaining messages are merged into the next item. If the merged item would hold more than
+                           max_merge messages the oldest item is dropped as a whole instead
+    With block set put waits for room instead, used when reading from file, until the finished event is set.
+    Shed buffers and messages, and the max backlog, are counted in the statistics.
+    """
+
+    POLICIES = ("drop-oldest", "drop-newest", "drop-low-priority")
+
+    def __init__(self, size, policy="drop-oldest", priority_df=(), block=False, finished=None, max_merge=1024):
+        self.logger = logging.getLogger('spots.BufferRing')
+        if policy not in self.POLICIES:
+            self.logger.info("BufferRing unknown overload policy {}, using drop-oldest".format(policy))
+            policy = "drop-oldest"
+        self.size = size
+        self.policy = policy
+        self.priority_df = priority_df
+        self.block = block
+        self.finished = finished if finished is not None else threading.Event()
+        self.max_merge = max_merge
+        self.ring = collections.deque()
+        self.cond = threading.Condition()
+
+    def put(self, item):
+        with self.cond:
+            if self.block:
+                while len(self.ring) >= self.size:
+                    if self.finished.is_set():
+                        return  # Nobody reads the ring any more
+                    self.cond.wait(1.0)
+            elif len(self.ring) >= self.size:
+                item = self._shed(item)
+                if item is None:
+                    return
+
+            self.ring.append(item)
+            if len(self.ring) > basic.statistics['max_backlog']:
+                basic.statistics['max_backlog'] = len(self.ring)
+            self.cond.notify_all()
+
+    def _shed(self, item):
+        """
+        Make room for item in a full ring, returns the item to append or None if it is dropped
+        """
+        if self.policy == "drop-newest":
+            self._count_shed(len(item), buffers=1)
+            return None
+
+        oldest = self.ring.popleft()
+        if self.policy == "drop-oldest":
+            self._count_shed(len(oldest), buffers=1)
+            return item
+
+        kept = self._high_priority(oldest)
+        if len(kept) and len(kept) + len(self.ring[0] if self.ring else item) > self.max_merge:
+            self._count_shed(len(oldest), buffers=1)
+            return item
+
+        self._count_shed(len(oldest) - len(kept), buffers=0 if len(kept) else 1)
+        if len(kept):
+            if self.ring:
+                self.ring[0] = self._merge(kept, self.ring[0])
+            else:
+                item = self._merge(kept, item)
+        return item
+
+    def _high_priority(self, item):
+        if isinstance(item, basic.FrameBatch):
+            dfs = item.downlink_formats().tolist()
+            return item.select([num for num, df in enumerate(dfs) if df in self.priority_df])
+        return [elem for elem in item if elem[1] >> (basic.ADSB.MODES_LONG_MSG_BITS - 5) in self.priority_df]
+
+    @staticmethod
+    def _merge(first, second):
+        if isinstance(first, basic.FrameBatch):
+            return basic.FrameBatch.concat([first, second])
+        return first + second
+
+    @staticmethod
+    def _count_shed(frames, buffers):
+        basic.statistics['shed_buffers'] += buffers
+        basic.statistics['shed_frames'] += frames
+
+    def get(self, timeout=None):
+        """
+        Remove and return the oldest item, raises Queue.Empty if there is none within timeout seconds
+        """
+        with self.cond:
+            if not self.ring:
+                self.cond.wait(timeout)
+            if not self.ring:
+                raise Queue.Empty
+            item = self.ring.popleft()
+            self.cond.notify_all()
+            return item
+
+    def empty(self):
+        return len(self.ring) == 0
+
+    def qsize(self):
+        return len(self.ring)
+
+
+class DemodPool:
+    """
+    Demodulates tuner buffers in worker processes, results are put on the tuner data queue in capture order
+
+    The raw buffers are copied into slots of shared memory, each preceded by the last SQUITTER_LONG_MAX_SIZE samples
+    (as IQ bytes) of the previous buffer, so that messages straddling two buffers are found. A worker converts a slot
+    to magnitudes, detects the preamble candidates and computes the crc syndromes, the FrameBatch is returned to a
+    collector thread. The collector orders the batches by sequence number, skips the candidates the previous buffer
+    already covered or that are within detected messages and puts the batch on the tuner data queue.
+
+    There are two slots per worker. When all slots are in use a buffer from the sdr is shed (counted in shed_buffers)
+    rather than blocking the sdr callback, the next buffer is then demodulated without the tail of the previous one.
+    When reading from file the tuner thread waits for a slot to be returned instead.
+    Per worker statistics are kept in basic.statistics['demod_workers'].
+    """
+
+    def __init__(self, tuner, workers):
+        self.tuner = tuner
+        self.logger = logging.getLogger('spots.DemodPool')
+
+        self.overlap = 2 * tuner.SQUITTER_LONG_MAX_SIZE  # In bytes, an i and q value per sample
+        self.slot_size = self.overlap + tuner.MODES_DATA_LEN
+        slots = 2 * workers
+        self.shm = multiprocessing.RawArray(ctypes.c_uint8, slots * self.slot_size)
+        self.mem = np.frombuffer(self.shm, dtype=np.uint8)
+
+        self.free_slots = Queue.Queue()
+        for slot in range(slots):
+            self.free_slots.put(slot)
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+
+        self.tail = self.mem[:0]  # The last raw bytes of the previous buffer
+        self.samples = 0  # Samples submitted
+        self.first_sample = {}  # Number of the first sample in each slot by sequence number, for the timestamps
+        self.submitted = 0
+        self.delivered = 0
+        self.resume = 0  # Where the scan of the previous buffer stopped, counted in the next buffer
+        self.done = threading.Condition()
+        self.finished = threading.Event()
+        self.start_time = time.time()
+
+        basic.statistics['demod_workers'] = {}
+        self.processes = []
+        for worker in range(workers):
+            basic.statistics['demod_workers'][str(worker)] = {'buffers': 0, 'frames': 0, 'busy_time': 0.0,
+                                                              'msps': 0.0, 'load': 0.0}
+            process = multiprocessing.Process(target=self._work, args=(worker,), name="Demod {}".format(worker))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+        self.collector = threading.Thread(target=self._collect, name="Demod collector")
+        self.collector.daemon = True
+
+        self.logger.info("DemodPool started {} workers".format(workers))
+
+    def _slot(self, slot):
+        return self.mem[slot * self.slot_size:(slot + 1) * self.slot_size]
+
+    def start(self):
+        self.start_time = time.time()
+        self.collector.start()
+
+    def submit(self, samples):
+        """
+        Called from the tuner thread, copies the raw buffer after the previous tail into a free slot
+        """
+        raw = samples if isinstance(samples, np.ndarray) else np.frombuffer(samples, dtype=np.uint8)
+        if self.tuner.filename is not None:
+            slot = self.free_slots.get()
+        else:
+            try:
+                slot = self.free_slots.get_nowait()
+            except Queue.Empty:
+                basic.statistics['shed_buffers'] += 1
+                self.tail = self.mem[:0]  # The next buffer does not continue this one
+                self.samples += len(raw) / 2
+                return
+        buf = self._slot(slot)
+        overlap = len(self.tail)
+        length = overlap + len(raw)
+        buf[:overlap] = self.tail
+        buf[overlap:length] = raw
+
+        end = length & ~1  # A trailing odd byte is ignored
+        self.tail = buf[end - min(self.overlap, end):end].copy()
+        self.first_sample[self.submitted] = self.samples - overlap / 2
+        self.samples += len(raw) / 2
+        self.tasks.put((self.submitted, slot, length, overlap / 2))
+        self.submitted += 1
+
+    def _work(self, worker):
+        """
+        Worker process, demodulates slots until told to stop (None)
+        """
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C is handled by the main process
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            seq, slot, length, overlap = task
+
+            start = time.time()
+            sig = self.tuner._iq_to_uint(self.tuner._iq_to_words(self._slot(slot)[:length]))
+            # Where the scan of this buffer starts depends on the previous buffer, which may not be done yet.
+            # So all candidates are returned and the collector skips those within detected messages
+            candidates, long_msgs = self.tuner._detect_candidates(sig)
+            frames = basic.FrameBatch(self.tuner._preamble_signal_strengths(sig, candidates),
+                                      self.tuner._slice_frames(sig, candidates), candidates)
+            frames.msgs()  # Computed here rather than in the main process
+            frames.syndromes()
+            self.results.put((worker, seq, slot, frames, long_msgs.tolist(), overlap, len(sig), time.time() - start))
+
+    def _collect(self):
+        """
+        Collector thread, returns slots and delivers the batches in the order they were submitted
+        """
+        pending = {}
+        while not self.finished.is_set():
+            try:
+                result = self.results.get(timeout=1.0)
+            except Queue.Empty:
+                continue
+
+            worker, seq, slot = result[:3]
+            self.free_slots.put(slot)
+            pending[seq] = result
+
+            while self.delivered in pending:
+                self._deliver(*pending.pop(self.delivered))
+                with self.done:
+                    self.delivered += 1
+                    self.done.notify_all()
+
+    def _deliver(self, worker, seq, slot, frames, long_msgs, overlap, length, busy):
+        """
+        Skip the candidates before where the previous buffer stopped and within detected messages, as the tuner
+        thread does, and put the batch on the tuner data queue
+        """
+        positions = frames.positions.tolist()
+        resume = self.resume if overlap else 0  # No overlap after a shed buffer, nothing was scanned before
+        keep, ind = self.tuner._skip_detected(positions, long_msgs, resume)
+        frames = frames.select(keep)
+        self.tuner.stamp(frames, [positions[num] for num in keep], self.first_sample.pop(seq))
+
+        basic.statistics['valid_preambles'] += len(keep)
+        basic.statistics['carry_over_frames'] += len([num for num in keep if positions[num] < overlap])
+        next_ind = max(ind, length - self.tuner.SQUITTER_LONG_MAX_SIZE)
+        self.resume = max(0, next_ind - (length - min(self.tuner.SQUITTER_LONG_MAX_SIZE, length)))
+
+        stats = basic.statistics['demod_workers'][str(worker)]
+        stats['buffers'] += 1
+        stats['frames'] += len(keep)
+        stats['busy_time'] += busy
+        stats['msps'] = round(stats['buffers'] * self.tuner.MODES_DATA_LEN / 2 / stats['busy_time'] / 1.0e6, 2)
+        stats['load'] = round(100.0 * stats['busy_time'] / max(time.time() - self.start_time, 1.0e-3), 1)
+
+        self.tuner.data.put(frames)
+        basic.budget.add('demod_workers', busy / len(self.processes))
+        basic.budget.buffer_done((length / 2 - overlap) / self.tuner.sample_rate)
+
+    def drain(self):
+        """
+        Wait until all submitted buffers are delivered
+        """
+        with self.done:
+            while self.delivered < self.submitted and not self.finished.is_set():
+                self.done.wait(1.0)
+
+    def close(self):
+        self.finished.set()
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(1.0)
@@ -12,6 +12,7 @@ setup(
                 ('client', ['map.html', 'spots.html', 'spots.js']),
                 ('radar', ['modes1.bin', 'radar.conf', 'spots_config.json', 'spots_emitter.conf', 'squitter.json'])],
     install_requires=['docutils>=0.3', 'Flask', 'pyrtlsdr', 'simplejson'],
+    extras_require={'numpy': ['numpy']},
     url='https://github.com/Wolfrax/spots',
     license='GPL',
     author='Mats Melander',